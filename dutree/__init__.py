@@ -38,6 +38,28 @@
 #     >>> leaf0.app_size() / (1024.0 * 1024 * 1024)
 #     12.092280263081193
 #
-from .dutree import DuScan as Scanner
+# Many path lookups on one tree::
+#
+#     >>> from dutree import TreeIndex
+#     >>> index = TreeIndex(tree)
+#     >>> index.size('/srv/data/audiofiles')
+#     12983942311
+#
+#     >>> index.find('/srv/data/tmp/x.iso').name()  # no node of its own
+#     '/srv/data/*'
+#
+# Combining the scans of many hosts::
+#
+#     >>> from dutree import DuMerge, dump, load
+#     >>> with open('host1.json', 'w') as fp:
+#     ...     dump(tree, fp, host='host1')
+#
+#     >>> merger = DuMerge()
+#     >>> for filename in ('host1.json', 'host2.json'):
+#     ...     with open(filename) as fp:
+#     ...         merger.add_file(fp)
+#     >>> merged = merger.merge()
+#
+from .dutree import DuMerge, DuScan as Scanner, TreeIndex, dump, load
 
-__all__ = ('Scanner',)
+__all__ = ('DuMerge', 'Scanner', 'TreeIndex', 'dump', 'load')
@@ -0,0 +1,106 @@
+# dutree -- a quick and memory efficient disk usage scanner
+# Copyright (C) 2018,2019  Walter Doekes, OSSO B.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# The benchmarks herein compare the dutree scan engines on a real on-disk
+# tree. Run them from this directory, optionally passing a path on the
+# filesystem you want to test (NFS, CephFS, ...):
+#
+#     python bench_dutree.py [PATH]
+#
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bogofs import GeneratedFilesystem
+
+import dutree
+
+
+def materialize(fs, dest):
+    """Write the GeneratedFilesystem to dest, using sparse files.
+
+    A single byte is written at the end of each file, so the st_blocks
+    is non-zero and dutree won't mistake them for pseudo-files.
+    """
+    for name, dirs, files in fs.walk('/'):
+        base = os.path.join(dest, name.lstrip('/'))
+        for dir_ in dirs:
+            os.mkdir(os.path.join(base, dir_))
+        for file_ in files:
+            size = fs.stat(name.rstrip('/') + '/' + file_).size
+            with open(os.path.join(base, file_), 'wb') as fp:
+                fp.seek(size - 1)
+                fp.write(b'\0')
+
+
+def bench(label, path, repeat=3, **kwargs):
+    "Run the scanner repeat times and print the best time."
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        tree = dutree.DuScan(path, **kwargs).scan()
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:24s} {:8.3f} s  ({} leaves, {} bytes)'.format(
+        label, best, len(tree.get_leaves()), tree.app_size()))
+
+
+def bench_inventory(path, repeat=3):
+    "Scan a find -printf inventory of path and print the best time."
+    inventory = subprocess.check_output(
+        ['find', path, '-printf', '%s %b %y %p\\n']).decode('utf-8')
+    lines = inventory.splitlines(True)
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        tree = dutree.DuScan(
+            path, backend=dutree.InventoryBackend(lines)).scan()
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:24s} {:8.3f} s  ({} leaves, {} bytes, {:.0f} lines/s)'.format(
+        'inventory', best, len(tree.get_leaves()), tree.app_size(),
+        len(lines) / best))
+
+
+def main():
+    if len(sys.argv) > 1:
+        path, tmpdir = sys.argv[1], None
+    else:
+        tmpdir = path = tempfile.mkdtemp(prefix='dutree-bench-')
+        materialize(GeneratedFilesystem(seed=1, maxdepth=3), path)
+
+    try:
+        bench('lstat', path)
+        bench('lstat (inode order)', path, inode_order=True)
+        bench('inodes (no lstat)', path, inodes=True)
+        if dutree.Statx.is_available():
+            bench('statx', path, engine='statx')
+            bench('statx (dont_sync)', path, engine='statx', dont_sync=True)
+        else:
+            print('statx: not available')
+        bench_inventory(path)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
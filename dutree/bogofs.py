@@ -21,9 +21,15 @@
 #
 from __future__ import print_function
 from random import Random
+from zlib import crc32
 
 
 class Node(object):
+    st_uid = 1000  # for stat
+    st_gid = 1000  # for stat
+    st_atime = 0  # for stat, Jan 1 1970 is "stale"
+    st_mtime = 0  # for stat
+
     def __init__(self, name, size):
         self.name = name
         self.size = size
@@ -107,6 +113,19 @@ class Python2Random(Random):
         return int(self.random() * width) + start
 
 
+class DirEntry(object):
+    "Like os.DirEntry, as returned by GeneratedFilesystem.scandir()."
+    def __init__(self, name, node):
+        self.name = name
+        self._node = node
+
+    def inode(self):
+        return self._node.st_ino
+
+    def is_dir(self, follow_symlinks=True):
+        return hasattr(self._node, 'dirs')
+
+
 class GeneratedFilesystem(object):
     DirNode = DirNode
     RegularFileNode = RegularFileNode
@@ -160,11 +179,14 @@ class GeneratedFilesystem(object):
     def _to_dict(self, ret, prefix, node):
         prefix += '/' + node.name
         ret[prefix[5:]] = node  # drop "/ROOT"
+        node.st_ino = crc32(prefix.encode('utf-8')) & 0xffffffff
 
         for dir_ in node.dirs:
             self._to_dict(ret, prefix, dir_)
         for file_ in node.files:
             ret[(prefix + '/' + file_.name)[5:]] = file_
+            file_.st_ino = crc32(
+                (prefix + '/' + file_.name).encode('utf-8')) & 0xffffffff
 
     def _normpath(self, path):
         if path.startswith('/./'):
@@ -201,14 +223,23 @@ class GeneratedFilesystem(object):
         """
         del self._cache_dict[path]
 
+    def isdir(self, path):
+        return path in self._cache_dict and hasattr(
+            self._cache_dict[path], 'dirs')
+
     def listdir(self, path):
         node = self._get_node(path)
         return (
             [i.name for i in node.dirs] +
             [i.name for i in node.files])
 
+    def scandir(self, path):
+        node = self._get_node(path)
+        return [DirEntry(i.name, i) for i in node.dirs + node.files]
+
     def stat(self, path):
         return self._get_node(path)
+    lstat = stat  # for the dutree Backend interface
 
     def walk(self, path):
         path = self._normpath(path)
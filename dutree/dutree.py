@@ -56,40 +56,536 @@
 # **NOTE**: On filesystems with built-in compression (like ZFS) or with many
 # sparse files, you may want to check the --count-blocks option.
 #
+import ctypes
+import ctypes.util
+import errno
+import grp
+import json
+import multiprocessing
+import os
+import platform
+import pwd
+import re
+import select
+import shutil
+import socket
+import struct
 import sys
+import threading
+import time
 import warnings
 
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from itertools import islice
 from os import listdir, lstat, path
-from stat import S_ISDIR, S_ISREG
+from stat import (
+    S_IFBLK, S_IFCHR, S_IFDIR, S_IFIFO, S_IFLNK, S_IFREG, S_IFSOCK,
+    S_ISDIR, S_ISREG)
+
+try:
+    from os import fsencode as _fsencode
+except ImportError:  # python2
+    def _fsencode(pathname):
+        if not isinstance(pathname, bytes):
+            pathname = pathname.encode(sys.getfilesystemencoding())
+        return pathname
+try:
+    array('q')
+    _INT64 = 'q'
+except ValueError:  # python2
+    # Only floats are left on ILP32/LLP64: exact up to 2 ** 53 bytes.
+    _INT64 = 'l' if array('l').itemsize >= 8 else 'd'
+try:
+    from os import scandir
+except ImportError:  # python2
+    scandir = None
+try:
+    from queue import Empty, Queue
+except ImportError:  # python2
+    from Queue import Empty, Queue
+try:
+    from time import monotonic as _monotonic
+except ImportError:  # python2
+    from time import time as _monotonic
 
 
 class OsWarning(UserWarning):
     pass
 
 
+class StatxResult(object):
+    "Subset of os.stat_result, as filled by statx()."
+    __slots__ = (
+        'st_mode', 'st_size', 'st_blocks', 'st_uid', 'st_gid', 'st_atime',
+        'st_mtime')
+
+    def __init__(self, st_mode, st_size, st_blocks, st_uid, st_gid,
+                 st_atime, st_mtime):
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_blocks = st_blocks
+        # Only valid if they were in the mask.
+        self.st_uid = st_uid
+        self.st_gid = st_gid
+        self.st_atime = st_atime
+        self.st_mtime = st_mtime
+
+
+class _StatxTimestamp(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_int64),
+        ('tv_nsec', ctypes.c_uint32),
+        ('_reserved', ctypes.c_int32),
+    ]
+
+
+class _Statx(ctypes.Structure):
+    "struct statx from <linux/stat.h> (256 bytes)."
+    _fields_ = [
+        ('stx_mask', ctypes.c_uint32),
+        ('stx_blksize', ctypes.c_uint32),
+        ('stx_attributes', ctypes.c_uint64),
+        ('stx_nlink', ctypes.c_uint32),
+        ('stx_uid', ctypes.c_uint32),
+        ('stx_gid', ctypes.c_uint32),
+        ('stx_mode', ctypes.c_uint16),
+        ('_spare0', ctypes.c_uint16),
+        ('stx_ino', ctypes.c_uint64),
+        ('stx_size', ctypes.c_uint64),
+        ('stx_blocks', ctypes.c_uint64),
+        ('stx_attributes_mask', ctypes.c_uint64),
+        ('stx_atime', _StatxTimestamp),
+        ('stx_btime', _StatxTimestamp),
+        ('stx_ctime', _StatxTimestamp),
+        ('stx_mtime', _StatxTimestamp),
+        ('stx_rdev_major', ctypes.c_uint32),
+        ('stx_rdev_minor', ctypes.c_uint32),
+        ('stx_dev_major', ctypes.c_uint32),
+        ('stx_dev_minor', ctypes.c_uint32),
+        ('_spare2', ctypes.c_uint64 * 14),
+    ]
+
+
+class Statx(object):
+    """Callable replacement for lstat() using Linux statx(2)
+
+    Only the type, size and blocks are requested, so network filesystems
+    (NFS, CephFS) need not revalidate all attributes. With dont_sync,
+    they may answer from their attribute cache altogether.
+    """
+    AT_FDCWD = -100
+    AT_SYMLINK_NOFOLLOW = 0x100
+    AT_STATX_DONT_SYNC = 0x4000
+    STATX_TYPE = 0x1
+    STATX_UID = 0x8
+    STATX_GID = 0x10
+    STATX_ATIME = 0x20
+    STATX_MTIME = 0x40
+    STATX_SIZE = 0x200
+    STATX_BLOCKS = 0x400
+
+    _statx = None  # libc statx(), set by is_available()
+
+    @classmethod
+    def is_available(cls):
+        "Return True if libc has a working statx()."
+        if cls._statx is None:
+            cls._statx = False
+            libc_name = ctypes.util.find_library('c')
+            try:
+                func = ctypes.CDLL(libc_name, use_errno=True).statx
+            except (AttributeError, OSError):
+                return False  # not glibc 2.28+, or not Linux at all
+            func.argtypes = (
+                ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint,
+                ctypes.POINTER(_Statx))
+            func.restype = ctypes.c_int
+            buf = _Statx()
+            if func(cls.AT_FDCWD, b'/', 0, cls.STATX_TYPE, buf) == 0:
+                cls._statx = func  # no ENOSYS from an old kernel
+        return bool(cls._statx)
+
+    def __init__(self, dont_sync=False, owner=False, times=False):
+        if not self.is_available():
+            raise OSError('statx() is not available on this system')
+        self._flags = self.AT_SYMLINK_NOFOLLOW
+        if dont_sync:
+            self._flags |= self.AT_STATX_DONT_SYNC
+        self._mask = self.STATX_TYPE | self.STATX_SIZE | self.STATX_BLOCKS
+        if owner:
+            self._mask |= self.STATX_UID | self.STATX_GID
+        if times:
+            self._mask |= self.STATX_ATIME | self.STATX_MTIME
+        self._buf = _Statx()
+        self._byref_buf = ctypes.byref(self._buf)
+
+    def __call__(self, pathname):
+        buf = self._buf
+        if self._statx(
+                self.AT_FDCWD, _fsencode(pathname), self._flags,
+                self._mask, self._byref_buf) != 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_), pathname)
+        return StatxResult(
+            buf.stx_mode, buf.stx_size, buf.stx_blocks, buf.stx_uid,
+            buf.stx_gid, buf.stx_atime.tv_sec, buf.stx_mtime.tv_sec)
+
+
+class TokenBucket(object):
+    """Rate limiter, shared safely between threads
+
+    take() blocks until the average rate is at most rate per second.
+    Up to burst tokens can be taken at once after an idle period.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(self.rate / 10, 1)  # 100ms worth
+        self._tokens = self.burst
+        self._last = _monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, tokens=1):
+        with self._lock:
+            now = _monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def wrap(self, func):
+        "Return func, taking a token before every call."
+        take = self.take
+
+        def throttled(*args):
+            take()
+            return func(*args)
+        return throttled
+
+
+def set_low_priority(io_idle=True, nice=19):
+    """Lower our CPU priority and (on Linux) our I/O priority
+
+    With the idle I/O class, the disks only serve us when nobody else
+    needs them. This is inherited by threads started afterwards. Returns
+    False if the I/O priority could not be set.
+    """
+    if nice:
+        os.nice(nice)
+    if not io_idle:
+        return True
+    IOPRIO_WHO_PROCESS, IOPRIO_CLASS_IDLE, IOPRIO_CLASS_SHIFT = 1, 3, 13
+    syscall_nr = {
+        'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+        'armv7l': 314, 'ppc64le': 273}.get(platform.machine())
+    if syscall_nr is None or not sys.platform.startswith('linux'):
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc.syscall(
+        syscall_nr, IOPRIO_WHO_PROCESS, 0,
+        IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+
+
+class TopCounter(object):
+    """Bytes and file count per key, keeping only the heaviest keys
+
+    For small key sets (uids, gids) this is an exact counter. When more
+    than twice the size keys are seen (file extensions), only the top
+    size keys are kept (a heavy hitters sketch). A key that shows up
+    after that may have had up to error() bytes dropped before; its
+    bytes include that error, so real heavy hitters are never missed.
+    """
+    def __init__(self, size=1000):
+        self._size = size
+        self._counts = {}  # key => [bytes, files, error]
+        self._error = 0
+
+    def add(self, key, size):
+        try:
+            count = self._counts[key]
+        except KeyError:
+            self._counts[key] = [self._error + size, 1, self._error]
+            if len(self._counts) > 2 * self._size:
+                self._shrink()
+        else:
+            count[0] += size
+            count[1] += 1
+
+    def _shrink(self):
+        items = sorted(
+            self._counts.items(), key=(lambda x: (-x[1][0], x[0])))
+        self._error = max(self._error, items[self._size][1][0])
+        self._counts = dict(items[0:self._size])
+
+    def error(self):
+        "Return the maximum over-estimate of keys that have been added."
+        return self._error
+
+    def merge(self, other):
+        "Add the counts of other; the errors add up."
+        for key, (size, files, error) in other._counts.items():
+            try:
+                count = self._counts[key]
+            except KeyError:
+                self._counts[key] = [
+                    self._error + size, files, self._error + error]
+            else:
+                count[0] += size
+                count[1] += files
+                count[2] += error
+        self._error += other._error
+        if len(self._counts) > 2 * self._size:
+            self._shrink()
+
+    @classmethod
+    def from_top(cls, items, error=0, size=1000):
+        "Recreate a counter from its top() and error()."
+        counter = cls(size=size)
+        counter._counts = dict(
+            (key, [size_, files, error_])
+            for key, size_, files, error_ in items)
+        counter._error = error
+        return counter
+
+    def top(self, n=None):
+        "Return (key, bytes, files, error) tuples, the largest first."
+        items = sorted(
+            self._counts.items(), key=(lambda x: (-x[1][0], x[0])))
+        return [
+            (key, count[0], count[1], count[2])
+            for key, count in items[0:n]]
+
+
+class ScanErrors(object):
+    """Bounded collection of the OSErrors seen during a scan
+
+    Keeps the error count per errno and per top level directory, and
+    the first few errors as examples. That way a tree with a million
+    unreadable entries does not flood stderr or eat memory.
+    """
+    def __init__(self, examples=10):
+        self._max_examples = examples
+        self.count = 0
+        self.by_errno = TopCounter(size=100)
+        self.by_dir = TopCounter(size=100)
+        self.examples = []  # (filename, errno, strerror) tuples
+
+    def __len__(self):
+        return self.count
+
+    def add(self, e, filename, topdir):
+        self.count += 1
+        self.by_errno.add(e.errno, 1)
+        self.by_dir.add(topdir, 1)
+        if len(self.examples) < self._max_examples:
+            self.examples.append((filename, e.errno, e.strerror))
+
+    def merge(self, other):
+        self.count += other.count
+        self.by_errno.merge(other.by_errno)
+        self.by_dir.merge(other.by_dir)
+        self.examples.extend(
+            other.examples[0:(self._max_examples - len(self.examples))])
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'by_errno': self.by_errno.top(),
+            'by_dir': self.by_dir.top(),
+            'examples': self.examples,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        errors = cls()
+        errors.count = data['count']
+        errors.by_errno = TopCounter.from_top(data['by_errno'], size=100)
+        errors.by_dir = TopCounter.from_top(data['by_dir'], size=100)
+        errors.examples = [tuple(i) for i in data['examples']]
+        return errors
+
+
+class SizeHistogram(object):
+    """File count and total bytes per log2 file size bucket
+
+    Bucket N holds the files of 2^(N-1) up to 2^N bytes; bucket 0 holds
+    the empty files.
+    """
+    __slots__ = ('counts', 'sizes')
+    BUCKETS = 48  # the last one holds everything from 128 TiB
+
+    def __init__(self):
+        self.counts = array(_INT64, [0]) * self.BUCKETS
+        self.sizes = array(_INT64, [0]) * self.BUCKETS
+
+    def add(self, size):
+        bucket = size.bit_length()
+        if bucket >= self.BUCKETS:
+            bucket = self.BUCKETS - 1
+        self.counts[bucket] += 1
+        self.sizes[bucket] += size
+
+    def merge(self, other):
+        counts, sizes = self.counts, self.sizes
+        for bucket in range(self.BUCKETS):
+            counts[bucket] += other.counts[bucket]
+            sizes[bucket] += other.sizes[bucket]
+
+    def buckets(self):
+        "Yield (min_size, max_size, count, bytes) for the non-empty buckets."
+        for bucket in range(self.BUCKETS):
+            if self.counts[bucket]:
+                if bucket == 0:
+                    min_size, max_size = 0, 0
+                else:
+                    min_size, max_size = 1 << (bucket - 1), (1 << bucket) - 1
+                yield (
+                    min_size, max_size, self.counts[bucket],
+                    self.sizes[bucket])
+
+    def as_list(self):
+        return [list(self.counts), list(self.sizes)]
+
+    @classmethod
+    def from_list(cls, data):
+        hist = cls()
+        hist.counts = array(_INT64, data[0])
+        hist.sizes = array(_INT64, data[1])
+        return hist
+
+
+class AgeBuckets(object):
+    "Bytes per age bucket: younger than a day, a week, a month, a year."
+    __slots__ = ('sizes',)
+    LIMITS = (86400, 7 * 86400, 30 * 86400, 365 * 86400)
+    LABELS = ('<1d', '<7d', '<30d', '<1y', 'older')
+
+    def __init__(self):
+        self.sizes = array(_INT64, [0]) * len(self.LABELS)
+
+    @classmethod
+    def get_bucket(cls, age):
+        "Return the bucket index for an age in seconds."
+        for bucket, limit in enumerate(cls.LIMITS):
+            if age < limit:
+                return bucket
+        return len(cls.LIMITS)
+
+    def add(self, bucket, size):
+        self.sizes[bucket] += size
+
+    def merge(self, other):
+        sizes = self.sizes
+        for bucket in range(len(sizes)):
+            sizes[bucket] += other.sizes[bucket]
+
+    def as_list(self):
+        return list(self.sizes)
+
+    @classmethod
+    def from_list(cls, data):
+        ages = cls()
+        ages.sizes = array(_INT64, data)
+        return ages
+
+
+class DuStats(object):
+    "The optional per-node statistics: a SizeHistogram and AgeBuckets."
+    __slots__ = ('hist', 'ages')
+
+    def __init__(self, histogram=False, ages=False):
+        self.hist = (SizeHistogram() if histogram else None)
+        self.ages = (AgeBuckets() if ages else None)
+
+    def add_file(self, app_size, size, age_bucket):
+        if self.hist is not None:
+            self.hist.add(app_size)
+        if self.ages is not None:
+            self.ages.add(age_bucket, size)
+
+    def add_other(self, size, age_bucket):
+        "Add a dir/symlink/etc.: it has an age, but it's not a file."
+        if self.ages is not None:
+            self.ages.add(age_bucket, size)
+
+    def merge(self, other):
+        if other.hist is not None:
+            if self.hist is None:
+                self.hist = SizeHistogram()
+            self.hist.merge(other.hist)
+        if other.ages is not None:
+            if self.ages is None:
+                self.ages = AgeBuckets()
+            self.ages.merge(other.ages)
+
+    def as_dict(self):
+        ret = {}
+        if self.hist is not None:
+            ret['hist'] = self.hist.as_list()
+        if self.ages is not None:
+            ret['ages'] = self.ages.as_list()
+        return ret
+
+    @classmethod
+    def from_dict(cls, data):
+        "Return DuStats from the node as_dict() output, or None."
+        if 'hist' not in data and 'ages' not in data:
+            return None
+        stats = cls()
+        if 'hist' in data:
+            stats.hist = SizeHistogram.from_list(data['hist'])
+        if 'ages' in data:
+            stats.ages = AgeBuckets.from_list(data['ages'])
+        return stats
+
+
 class DuNode:
-    "Disk Usage Tree node"
+    """Disk Usage Tree node
+
+    Nodes only store their own name. The full path is built from the
+    parent nodes when needed, so the common prefixes aren't stored over
+    and over again. The root node has the full scan path as name.
+    """
+    __slots__ = (
+        '_name', '_parent', '_isdir', '_app_size', '_use_size', '_nodes',
+        '_stats')
+
+    @classmethod
+    def new_dir(cls, name):
+        return cls(name, isdir=True, app_size=None, use_size=None)
 
     @classmethod
-    def new_dir(cls, pathname):
-        return cls(pathname, isdir=True, app_size=None, use_size=None)
+    def new_file(cls, name, app_size, use_size):
+        return cls(name, isdir=False, app_size=app_size, use_size=use_size)
 
     @classmethod
-    def new_file(cls, pathname, app_size, use_size):
-        return cls(pathname, isdir=False, app_size=app_size, use_size=use_size)
+    def new_leftovers(cls, app_size, use_size):
+        return cls('*', isdir=None, app_size=app_size, use_size=use_size)
 
     @classmethod
-    def new_leftovers(cls, pathname, app_size, use_size):
-        # An FF for better sorting, since we sort by pathname at the end.
-        return cls(
-            pathname + '/\xff*',
-            isdir=None, app_size=app_size, use_size=use_size)
-
-    def __init__(self, pathname, isdir, app_size, use_size):
-        self._path = pathname
+    def from_dict(cls, data):
+        "Create a node and its branches from as_dict() output."
+        isdir = {'dir': True, 'file': False, 'rest': None}[data['type']]
+        if 'nodes' not in data:
+            node = cls(data['name'], isdir, data['app'], data['use'])
+            node._stats = DuStats.from_dict(data)
+            return node
+
+        node = cls(data['name'], isdir, None, None)
+        node.add_branches(*[cls.from_dict(i) for i in data['nodes']])
+        return node
+
+    def __init__(self, name, isdir, app_size, use_size):
+        self._name = name
+        self._parent = None  # set by add_branches
         self._isdir = isdir  # false=file, true=dir, none=mixed
         self._app_size = app_size  # "apparent" size
         self._use_size = use_size  # real used size (from st_blocks)
+        self._stats = None  # DuStats of leaf nodes, if collected
         assert (
             (None, None) == (app_size, use_size) or   # both None
             None not in (app_size, use_size))         # none None
@@ -102,8 +598,91 @@ class DuNode:
 
     def add_branches(self, *nodes):
         "Add a branches to a non-leaf node."
+        for node in nodes:
+            node._parent = self
         self._nodes.extend(nodes)
 
+    def _insert_branch(self, node):
+        "Add a branch, keeping the leftover node last."
+        node._parent = self
+        if self._nodes and self._nodes[-1]._isdir is None:
+            self._nodes.insert(len(self._nodes) - 1, node)
+        else:
+            self._nodes.append(node)
+
+    def _make_branch(self):
+        "Turn a leaf into a non-leaf node, moving its size to leftovers."
+        app_size, use_size = self._app_size, self._use_size
+        self._app_size = self._use_size = None
+        self._isdir = True
+        self._nodes = []
+        self.add_branches(DuNode.new_leftovers(app_size, use_size))
+
+    def _get_branch(self, name):
+        "Return the dir branch by name, creating it if needed."
+        if self._nodes is None:
+            self._make_branch()
+        for node in self._nodes:
+            if node._name == name and node._isdir is not None:
+                return node
+        node = DuNode.new_dir(name)
+        self._insert_branch(node)
+        return node
+
+    def _merge(self, other):
+        "Add the sizes and branches of other, which has the same path."
+        if other._nodes is None:
+            if self._nodes is None:
+                target = self
+                self._add_size(other._app_size, other._use_size)
+            elif not self._nodes:
+                target = self
+                self._set_size(other._app_size, other._use_size)
+            elif self._nodes[-1]._isdir is None:
+                target = self._nodes[-1]
+                target._add_size(other._app_size, other._use_size)
+            else:
+                target = DuNode.new_leftovers(
+                    other._app_size, other._use_size)
+                self.add_branches(target)
+            target._add_stats(other._stats)
+            return
+
+        if self._nodes is None:
+            self._make_branch()
+        # Not by _sort_key(): one tree may have collapsed a dir that the
+        # other still has branches for. _merge() expands the leaf then.
+        by_name = dict(
+            ((node._name, node._isdir is None), node)
+            for node in self._nodes)
+        for node in other._nodes:
+            key = (node._name, node._isdir is None)
+            if key in by_name:
+                by_name[key]._merge(node)
+            else:
+                self._insert_branch(node)
+
+    def _sort_key(self):
+        """Return key to sort branches the way their paths would sort.
+
+        A non-leaf node has only paths starting with "NAME/", which sort
+        differently from a plain "NAME" (think "a/" vs. "a.txt"). The
+        leftover node always sorts last.
+        """
+        if self._nodes is None:
+            return (self._isdir is None, self._name)
+        return (False, self._name + '/')
+
+    def path(self):
+        "Return the path, without a trailing slash for directories."
+        names = []
+        node = self
+        while node is not None:
+            names.append(node._name)
+            node = node._parent
+        names.reverse()
+        return '/'.join(names)
+
     def count(self):
         "Return how many nodes this contains, including self."
         if self._nodes is None:
@@ -111,11 +690,9 @@ class DuNode:
         return sum(i.count() for i in self._nodes)
 
     def name(self):
-        if self._isdir is None:
-            return self._path.split('\xff')[0] + '*'  # remove the sorting FF
-        elif self._isdir:
-            return self._path + '/'
-        return self._path
+        if self._isdir:
+            return self.path() + '/'
+        return self.path()
 
     def app_size(self):
         "Return the total apparent size, including children."
@@ -134,8 +711,39 @@ class DuNode:
         self._app_size += app_size
         self._use_size += use_size
 
+    def stats(self):
+        "Return the DuStats, including children, if they were collected."
+        if self._nodes is None:
+            return self._stats
+
+        ret = None
+        for node in self._nodes:
+            stats = node.stats()
+            if stats is not None:
+                if ret is None:
+                    ret = DuStats()
+                ret.merge(stats)
+        return ret
+
+    def histogram(self):
+        "Return the SizeHistogram of the files, if it was collected."
+        stats = self.stats()
+        return stats and stats.hist
+
+    def ages(self):
+        "Return the AgeBuckets, if they were collected."
+        stats = self.stats()
+        return stats and stats.ages
+
+    def _add_stats(self, stats):
+        if stats is not None:
+            if self._stats is None:
+                self._stats = DuStats()
+            self._stats.merge(stats)
+
     def _set_size(self, app_size, use_size):
         assert self._nodes is not None
+        self._stats = self.stats()
         self._app_size = app_size
         self._use_size = use_size
         self._nodes = None
@@ -174,9 +782,11 @@ class DuNode:
         keep_nodes = []
         prune_app_size = 0
         prune_use_size = 0
+        prune_stats = []
         for node in self._nodes:
             node_size = node.app_size() if a_or_u else node.use_size()
             if node_size < small_size:
+                prune_stats.append(node.stats())
                 if a_or_u:
                     prune_app_size += node_size
                     prune_use_size += node.use_size()
@@ -190,6 +800,7 @@ class DuNode:
         if len(keep_nodes) == 1 and keep_nodes[-1]._isdir is None:
             prune_app_size += keep_nodes[-1]._app_size
             prune_use_size += keep_nodes[-1]._use_size
+            prune_stats.append(keep_nodes[-1]._stats)
             keep_nodes = []
 
         if prune_app_size or prune_use_size:
@@ -202,10 +813,16 @@ class DuNode:
             elif keep_nodes and keep_nodes[-1]._isdir is None:
                 # There was already a leftover node. Add the new leftovers.
                 keep_nodes[-1]._add_size(prune_app_size, prune_use_size)
+                for stats in prune_stats:
+                    keep_nodes[-1]._add_stats(stats)
             else:
                 # Create a new leftover node.
-                keep_nodes.append(DuNode.new_leftovers(
-                    self._path, prune_app_size, prune_use_size))
+                leftovers = DuNode.new_leftovers(
+                    prune_app_size, prune_use_size)
+                leftovers._parent = self
+                for stats in prune_stats:
+                    leftovers._add_stats(stats)
+                keep_nodes.append(leftovers)
 
         # Update nodes and do the actual assertion.
         self._nodes = keep_nodes
@@ -248,6 +865,7 @@ class DuNode:
                 if tail._isdir is None:
                     assert tail._app_size is not None, tail
                     tail._add_size(node.app_size(), node.use_size())
+                    tail._add_stats(node.stats())
                     parents[-1]._nodes.remove(node)
                     assert len(parents[-1]._nodes)
 
@@ -280,32 +898,559 @@ class DuNode:
 
     def get_leaves(self):
         "Return a sorted leaves: only nodes with fixed file size."
-        leaves = self._get_leaves()
-        leaves.sort(key=(lambda x: x._path))  # FF sorts "mixed" last
+        leaves = []
+        self._get_sorted_leaves(leaves)
         return leaves
 
-    def _get_leaves(self):
+    def _get_sorted_leaves(self, leaves):
         if self._nodes is None:
-            return [self]
+            leaves.append(self)
+            return
 
-        ret = []
-        for node in self._nodes:
-            ret.extend(node._get_leaves())
+        for node in sorted(self._nodes, key=DuNode._sort_key):
+            node._get_sorted_leaves(leaves)
+
+    def as_dict(self):
+        "Return the node and its branches as a JSON-serializable dict."
+        ret = {
+            'name': self._name,
+            'type': {True: 'dir', False: 'file', None: 'rest'}[self._isdir]}
+        if self._nodes is None:
+            ret['app'] = self._app_size
+            ret['use'] = self._use_size
+            if self._stats is not None:
+                ret.update(self._stats.as_dict())
+        else:
+            ret['nodes'] = [node.as_dict() for node in self._nodes]
         return ret
 
     def __repr__(self):
-        name = self._path
-        if self._isdir:
-            name += '/'
+        name = self.name()
         return '  {:12d}  {}'.format(self.app_size(), name)
 
 
+class _NodeStore(object):
+    """Column store for the nodes retained during a scan
+
+    Instead of a DuNode object with a full path per node, every node is a
+    row in a few arrays, referring to its parent by row number. Because
+    the scan is depth first, a directory is followed by its descendants
+    only, so dropping a directory is a matter of truncating the arrays.
+
+    Directories that have branches (or are still being scanned) have -1
+    for their sizes.
+    """
+    KIND_FILE, KIND_DIR, KIND_REST = 0, 1, 2
+    ISDIR = {KIND_FILE: False, KIND_DIR: True, KIND_REST: None}
+
+    # Approximate memory used by a row, including the name.
+    ROW_BYTES = 100
+
+    def __init__(self, stats=False):
+        self.parent = array('l')
+        self.app = array(_INT64)
+        self.use = array(_INT64)
+        self.kind = array('b')
+        self.name = []
+        self.stats = ({} if stats else None)  # DuStats by row
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, parent, kind, name, app_size, use_size):
+        "Add a row and return its row number."
+        self.parent.append(parent)
+        self.app.append(app_size)
+        self.use.append(use_size)
+        self.kind.append(kind)
+        self.name.append(name)
+        return len(self.kind) - 1
+
+    def set_size(self, row, app_size, use_size):
+        self.app[row] = app_size
+        self.use[row] = use_size
+
+    def as_dict(self):
+        "Return the rows as a JSON-serializable dict, for checkpoints."
+        return {
+            'parent': self.parent.tolist(), 'app': self.app.tolist(),
+            'use': self.use.tolist(), 'kind': self.kind.tolist(),
+            'name': self.name, 'stats': (
+                None if self.stats is None else dict(
+                    (str(row), stats.as_dict())
+                    for row, stats in self.stats.items()))}
+
+    @classmethod
+    def from_dict(cls, data):
+        store = cls(stats=(data['stats'] is not None))
+        for column in ('parent', 'app', 'use', 'kind'):
+            getattr(store, column).extend(data[column])
+        store.name = data['name']
+        if store.stats is not None:
+            store.stats = dict(
+                (int(row), DuStats.from_dict(stats))
+                for row, stats in data['stats'].items())
+        return store
+
+    def truncate(self, row):
+        "Drop row and all rows after it."
+        if self.stats is not None:
+            for dropped_row in range(row, len(self)):
+                self.stats.pop(dropped_row, None)
+        for column in (self.parent, self.app, self.use, self.kind, self.name):
+            del column[row:]
+
+    def compact(self, small_size, stack, a_or_u):
+        """Merge finished nodes smaller than small_size into their parent.
+
+        The stack holds the [row, app, use, stats, ...] lists of the
+        directories that are still being scanned. Those are kept, but what
+        gets merged into them is added to their app/use, and their rows are
+        renumbered.
+        """
+        n = len(self)
+        parent, app, use, kind = self.parent, self.app, self.use, self.kind
+
+        # Sum the sizes upwards; children always come after their parent.
+        app_total = [0] * n
+        use_total = [0] * n
+        for row in range(n - 1, -1, -1):
+            if app[row] >= 0:
+                app_total[row] += app[row]
+                use_total[row] += use[row]
+            if row:
+                app_total[parent[row]] += app_total[row]
+                use_total[parent[row]] += use_total[row]
+        totals = (use_total, app_total)[a_or_u]
+
+        frames = dict((frame[0], frame) for frame in stack)
+        rest_rows = dict(
+            (parent[row], row) for row in range(n)
+            if kind[row] == self.KIND_REST)
+
+        keep = [True] * n
+        dest = [None] * n  # the frame or rest row a dropped row went into
+        for row in range(1, n):
+            parent_row = parent[row]
+            if not keep[parent_row]:
+                keep[row] = False  # already counted with the parent
+                dest[row] = dest[parent_row]
+            elif (row in frames or kind[row] == self.KIND_REST or
+                    totals[row] >= small_size):
+                pass
+            elif parent_row in frames:
+                frames[parent_row][1] += app_total[row]
+                frames[parent_row][2] += use_total[row]
+                keep[row] = False
+                dest[row] = frames[parent_row]
+            else:
+                rest_row = rest_rows[parent_row]
+                app[rest_row] += app_total[row]
+                use[rest_row] += use_total[row]
+                keep[row] = False
+                dest[row] = rest_row
+
+        if self.stats is not None:
+            for row in range(1, n):
+                if not keep[row] and row in self.stats:
+                    if isinstance(dest[row], list):
+                        dest[row][3].merge(self.stats[row])
+                    else:
+                        self.stats.setdefault(
+                            dest[row], DuStats()).merge(self.stats[row])
+
+        # Rebuild the columns with only the kept rows.
+        new_row = [-1] * n
+        new = _NodeStore(stats=(self.stats is not None))
+        for row in range(n):
+            if keep[row]:
+                new_row[row] = new.append(
+                    (new_row[parent[row]] if row else -1), kind[row],
+                    self.name[row], app[row], use[row])
+                if self.stats and row in self.stats:
+                    new.stats[new_row[row]] = self.stats[row]
+        for frame in stack:
+            frame[0] = new_row[frame[0]]
+        self.parent, self.app, self.use = new.parent, new.app, new.use
+        self.kind, self.name, self.stats = new.kind, new.name, new.stats
+
+    def to_node(self):
+        "Return the rows as a tree of DuNode objects."
+        nodes = []
+        for row in range(len(self)):
+            isdir = self.ISDIR[self.kind[row]]
+            if self.app[row] < 0:
+                node = DuNode(self.name[row], isdir, None, None)
+            else:
+                node = DuNode(
+                    self.name[row], isdir, self.app[row], self.use[row])
+                if self.stats is not None:
+                    node._stats = self.stats.get(row)
+            if row:
+                nodes[self.parent[row]].add_branches(node)
+            nodes.append(node)
+        return nodes[0]
+
+
+class Backend(object):
+    """Filesystem interface used by DuScan
+
+    Any object with these methods will do, like
+    bogofs.GeneratedFilesystem. The scanner walks depth first: it stats
+    each name right after listdir() yields it, and it lists a directory
+    right after stat'ing it, before taking the next name. So listdir()
+    may return a lazy iterator over a stream (see InventoryBackend).
+    """
+    scandir = None  # optional, needed for DuScan(inode_order=True)
+    streaming = False  # if set, only a single DuScan can use it
+
+    def isdir(self, path):
+        raise NotImplementedError()
+
+    def listdir(self, path):
+        "Return/yield the names in directory path."
+        raise NotImplementedError()
+
+    def lstat(self, path):
+        "Return an os.lstat() like result, or raise OSError."
+        raise NotImplementedError()
+
+
+class LocalBackend(Backend):
+    "The local filesystem, through the os module."
+    def __init__(self):
+        # Set on the instance, so the scanner calls them directly.
+        self.isdir = path.isdir
+        self.listdir = listdir
+        self.lstat = lstat
+        self.scandir = scandir
+
+
+class InventoryBackend(Backend):
+    """Stream a filesystem inventory instead of touching the filesystem
+
+    Reads the output of ``find PATH -printf '%s %b %y %p\\n'`` from fp.
+    Any other inventory (GPFS or Lustre policy engine lists) works when
+    converted to that format, or when parse_line is passed. It must be
+    in find order: a directory is listed before its contents, and a
+    directory's contents are listed together. Only a single line is
+    read ahead. The inventory has no owner and time information.
+    """
+    streaming = True
+    TYPES = {
+        'f': S_IFREG, 'd': S_IFDIR, 'l': S_IFLNK, 'b': S_IFBLK,
+        'c': S_IFCHR, 'p': S_IFIFO, 's': S_IFSOCK}
+
+    @classmethod
+    def parse_line(cls, line):
+        "Parse a '%s %b %y %p' line into (path, stat result)."
+        size, blocks, type_, path_ = line.rstrip('\n').split(' ', 3)
+        return path_, StatxResult(
+            cls.TYPES.get(type_, 0), int(size), int(blocks),
+            None, None, 0, 0)
+
+    def __init__(self, fp, parse_line=None):
+        if parse_line is not None:
+            self.parse_line = parse_line
+        self._lines = iter(fp)
+        self._peek = None  # (path, st) of the line read ahead
+        self._current = (None, None)  # (path, st) of the last listed name
+        self._advance()
+        if self._peek is None or not S_ISDIR(self._peek[1].st_mode):
+            raise ValueError('Inventory does not start with a directory')
+        self._root = self._peek[0].rstrip('/') or '/'
+        self._advance()
+
+    def _advance(self):
+        for line in self._lines:
+            if line.strip():
+                self._peek = self.parse_line(line)
+                return
+        self._peek = None
+
+    def isdir(self, path):
+        return (path.rstrip('/') or '/') == self._root
+
+    def listdir(self, path):
+        prefix = path if path.endswith('/') else path + '/'
+        while self._peek is not None and self._peek[0].startswith(prefix):
+            name = self._peek[0][len(prefix):]
+            if '/' in name:
+                raise ValueError(
+                    'Inventory is not in find order at {!r}'.format(
+                        self._peek[0]))
+            self._current = self._peek
+            self._advance()
+            yield name
+        if path.rstrip('/') == self._root.rstrip('/') and (
+                self._peek is not None):
+            raise ValueError(
+                'Inventory is not in find order at {!r}'.format(
+                    self._peek[0]))
+
+    def lstat(self, path):
+        if self._current[0] != path:
+            raise OSError(errno.ENOENT, 'Not in inventory order', path)
+        return self._current[1]
+
+
+class _CallThread(object):
+    "A thread making the calls of a WatchdogBackend, until one stalls."
+    def __init__(self):
+        self._requests = Queue()
+        self._results = Queue()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True  # may be stuck in the kernel forever
+        thread.start()
+
+    def _run(self):
+        while True:
+            func, arg = self._requests.get()
+            try:
+                result = (True, func(arg))
+            except BaseException as e:
+                result = (False, e)
+            self._results.put(result)
+
+    def call(self, func, arg, timeout):
+        "Return func(arg); raise Empty if it takes too long."
+        self._requests.put((func, arg))
+        ok, result = self._results.get(timeout=timeout)
+        if not ok:
+            raise result
+        return result
+
+    def is_stuck(self):
+        "Return True if the stalled call still hasn't returned."
+        return self._results.empty()
+
+
+class WatchdogBackend(Backend):
+    """Backend making the calls of another one, with a timeout
+
+    The calls are made by a helper thread (one per scanning thread). A
+    call that takes longer than timeout seconds, like any call on a dead
+    NFS server, is abandoned along with its thread: it raises an OSError
+    with ETIMEDOUT, so the scan records it and continues elsewhere.
+    Further calls below the same mount point fail right away, until the
+    stalled call returns after all.
+
+    The stalls attribute counts the failed calls per mount point, and
+    timed_out lists the first paths of which the subtree is missing.
+
+    With prestat, scandir() also stats the entries in the helper thread,
+    ahead of the lstat() calls. DuScan turns that off when the lstat()
+    calls themselves must be throttled or made in inode order.
+    """
+    MAX_TIMED_OUT = 100
+
+    def __init__(self, backend=None, timeout=10, mount_points=None,
+                 prestat=True):
+        self._backend = backend or LocalBackend()
+        self._timeout = timeout
+        self.prestat = prestat
+        if mount_points is None:
+            mount_points = get_mount_points()
+        # Longest first, so the first match is the right one.
+        self._mount_points = sorted(
+            (mount_point.rstrip('/') for mount_point in mount_points),
+            key=len, reverse=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stuck = {}  # mount point => stuck _CallThread
+        self.stalls = {}  # mount point => number of failed calls
+        self.timed_out = []
+        self.isdir = self._backend.isdir
+        self.streaming = getattr(self._backend, 'streaming', False)
+        if getattr(self._backend, 'scandir', None) is not None:
+            self.scandir = self._scandir
+
+    def _get_mount_point(self, pathname):
+        for mount_point in self._mount_points:
+            if (pathname == mount_point or
+                    pathname.startswith(mount_point + '/')):
+                return mount_point or '/'
+        return '/'
+
+    def _call(self, func, pathname, arg=False):
+        "Return func(arg, or else pathname), or raise ETIMEDOUT."
+        if self._stuck:
+            mount_point = self._get_mount_point(pathname)
+            with self._lock:
+                thread = self._stuck.get(mount_point)
+                if thread is not None and not thread.is_stuck():
+                    del self._stuck[mount_point]  # it came back
+                    thread = None
+                if thread is not None:
+                    self.stalls[mount_point] += 1
+            if thread is not None:
+                raise OSError(
+                    errno.ETIMEDOUT, 'Mount point {0} stalled'.format(
+                        mount_point), pathname)
+
+        thread = getattr(self._local, 'thread', None)
+        if thread is None:
+            thread = self._local.thread = _CallThread()
+        try:
+            return thread.call(func, pathname if arg is False else arg,
+                               self._timeout)
+        except Empty:
+            pass
+        self._local.thread = None  # abandon it
+        mount_point = self._get_mount_point(pathname)
+        with self._lock:
+            self._stuck[mount_point] = thread
+            self.stalls[mount_point] = self.stalls.get(mount_point, 0) + 1
+            if len(self.timed_out) < self.MAX_TIMED_OUT:
+                self.timed_out.append(pathname)
+        raise OSError(
+            errno.ETIMEDOUT, 'Timed out after {0} s'.format(self._timeout),
+            pathname)
+
+    def listdir(self, pathname):
+        return self._call(self._backend.listdir, pathname)
+
+    def lstat(self, pathname):
+        stats = getattr(self._local, 'stats', None)
+        if stats and pathname in stats:
+            st = stats.pop(pathname)  # done by _scandir
+            if isinstance(st, OSError):
+                raise st
+            return st
+        return self._call(self._backend.lstat, pathname)
+
+    def _scandir(self, pathname):
+        """Yield the entries, read and stat'ed in batches by the thread.
+
+        Handing every single lstat() to the thread would make the scan
+        several times slower. A batch ends after a tenth of the timeout,
+        so a slow but working server doesn't time out.
+        """
+        scandir_, lstat_ = self._backend.scandir, self._backend.lstat
+        prestat = self.prestat
+        prefix = pathname.rstrip('/') + '/'
+        max_time = self._timeout / 10.0
+
+        def read(entries):
+            "Return the entries iterator, a batch and whether it's done."
+            if entries is None:
+                entries = iter(scandir_(pathname))
+            batch = []
+            deadline = _monotonic() + max_time
+            for entry in entries:
+                st = None
+                if prestat:
+                    try:
+                        st = lstat_(prefix + entry.name)
+                    except OSError as e:
+                        st = e
+                batch.append((entry, st))
+                if len(batch) == 1000 or _monotonic() > deadline:
+                    return entries, batch, False
+            return entries, batch, True
+
+        if getattr(self._local, 'stats', None) is None:
+            self._local.stats = {}
+        stats = self._local.stats
+        entries, done, batch = None, False, ()
+        try:
+            while not done:
+                self._drop_stats(prefix, batch)
+                # Small directories take a single call.
+                entries, batch, done = self._call(read, pathname, entries)
+                if prestat:
+                    stats.update(
+                        (prefix + entry.name, st) for entry, st in batch)
+                for entry, st in batch:
+                    yield entry
+        finally:
+            self._drop_stats(prefix, batch)
+
+    def _drop_stats(self, prefix, batch):
+        """Forget the results of the batch that were never lstat()'ed.
+
+        Like the entries skipped when resuming, or those left when the
+        scan of the directory is abandoned.
+        """
+        stats = self._local.stats
+        if stats:
+            for entry, st in batch:
+                stats.pop(prefix + entry.name, None)
+
+
+class _ListdirEntry(object):
+    "Like os.DirEntry, for backends without scandir(); is_dir() stats."
+    def __init__(self, pathname, name, lstat_):
+        self.name = name
+        self._path = pathname + '/' + name
+        self._lstat = lstat_
+
+    def is_dir(self, follow_symlinks=True):
+        assert not follow_symlinks
+        return S_ISDIR(self._lstat(self._path).st_mode)
+
+
 class DuScan:
     "Disk Usage Tree scanner"
 
-    def __init__(self, pathname):
+    # With inode_order, stat this many directory entries at a time.
+    INODE_WINDOW = 10000
+    # Within a directory, look at the checkpoint clock this often.
+    CHECKPOINT_EVERY = 1000
+
+    def __init__(self, pathname, engine='lstat', dont_sync=False,
+                 max_nodes=None, histogram=False, aggregate=(), ages=False,
+                 use_atime=False, min_age=None, verbose=False, detail=20,
+                 inode_order=False, backend=None, exclude=(), max_iops=None,
+                 max_dirs_per_sec=None, checkpoint=None,
+                 checkpoint_interval=60, expected_size=None, inodes=False):
         self._path = self._normpath(pathname)
         self._tree = None
+        self._backend = backend or LocalBackend()
+        # Directories not to descend into, e.g. because they are scanned
+        # separately. Their own size is still counted.
+        self._exclude = frozenset(self._normpath(i) for i in exclude)
+        # Write the scan state to this file every so many seconds, so an
+        # interrupted scan can be resumed. The position in each listing
+        # is saved, so this relies on an unchanged directory order.
+        self._checkpoint = checkpoint
+        self._checkpoint_interval = checkpoint_interval
+        if checkpoint and getattr(self._backend, 'streaming', False):
+            raise ValueError('Cannot checkpoint a streaming backend')
+        self._engine = engine
+        self._dont_sync = dont_sync
+        self._inode_order = inode_order  # lstat() in inode number order
+        # Count directory entries instead of bytes. That needs no lstat()
+        # at all, so there are no sizes, owners or times to look at.
+        self._inodes = inodes
+        if inodes and (engine != 'lstat' or inode_order or histogram or
+                       aggregate or ages or min_age):
+            raise ValueError(
+                'Counting inodes does not stat; cannot use engine, '
+                'inode_order, histogram, aggregate, ages or min_age')
+        # Rate limits (numbers or shared TokenBucket objects): max_iops
+        # for all listdir/lstat calls, max_dirs_per_sec for listdir only.
+        self._max_iops = max_iops
+        self._max_dirs_per_sec = max_dirs_per_sec
+        self._max_nodes = max_nodes  # force prunes above this node count
+        self._detail = detail  # keep nodes of at least 1/detail of total
+        self._histogram = histogram  # collect SizeHistogram per node
+        self._ages = ages  # collect AgeBuckets per node
+        self._age_attr = ('st_atime' if use_atime else 'st_mtime')
+        self._min_age = min_age  # only count data older than this (secs)
+        for key in aggregate:
+            if key not in ('uid', 'gid', 'ext'):
+                raise ValueError('Unknown aggregate {!r}'.format(key))
+        # Bytes per uid/gid/ext, filled during scan().
+        self.aggregates = dict((key, TopCounter()) for key in aggregate)
+        # OSErrors, filled during scan(); also warned about if verbose.
+        self.errors = ScanErrors()
+        self._verbose = verbose
+        # The expected total (from statvfs or a previous scan) seeds the
+        # fraction, so the scan doesn't keep every node it sees before the
+        # subtotal has grown.
+        self._expected_size = expected_size
+        self._min_fraction = _seed_fraction(expected_size, detail)
         self._check_path()
 
     def _normpath(self, pathname):
@@ -319,77 +1464,391 @@ class DuScan:
 
     def _check_path(self):
         "Immediately check if we can access path. Otherwise bail."
-        if not path.isdir(self._path or '/'):
+        if not self._backend.isdir(self._path or '/'):
             raise OSError('Path {!r} is not a directory'.format(self._path))
 
-    def scan(self, use_apparent_size=True):
+    def _get_lstat(self):
+        "Return the lstat() function for the selected engine."
+        if self._engine == 'statx':
+            if not isinstance(self._backend, LocalBackend):
+                raise ValueError('The statx engine needs the local backend')
+            if Statx.is_available():
+                return Statx(
+                    dont_sync=self._dont_sync,
+                    owner=('uid' in self.aggregates or
+                           'gid' in self.aggregates),
+                    times=bool(self._ages or self._min_age))
+            warnings.warn(
+                'statx() is unavailable, using lstat() instead', OsWarning)
+        elif self._engine != 'lstat':
+            raise ValueError('Unknown engine {!r}'.format(self._engine))
+        return self._backend.lstat
+
+    def scan(self, use_apparent_size=True, merge_upwards=True, resume=None):
+        """Scan the path and return the tree.
+
+        Pass the load_checkpoint() result as resume, to continue an
+        interrupted scan.
+        """
         assert self._tree is None
-        self._tree = DuNode.new_dir(self._path)
-        self._app_subtotal = self._use_subtotal = 0
+        self._lstat = self._get_lstat()
+        self._listdir = self._backend.listdir
+        self._scandir = getattr(self._backend, 'scandir', None)
+        if self._inode_order and self._scandir is None:
+            warnings.warn(
+                'scandir() is unavailable, not sorting by inode', OsWarning)
+            self._inode_order = False
+        if ((self._inode_order or self._max_iops or self._inodes) and
+                getattr(self._backend, 'prestat', False)):
+            # A WatchdogBackend would stat ahead of our throttled or
+            # sorted lstat() calls, or for nothing when counting inodes.
+            self._backend.prestat = False
+        self._throttle()
+        # [row, app, use, stats, mixed_app, mixed_use, name, index] of
+        # the dirs being scanned; see _scan().
+        self._stack = []
+        self._now = time.time()
+        self._next_checkpoint = _monotonic() + self._checkpoint_interval
+        if resume:
+            frames = self._restore_checkpoint(resume, use_apparent_size)
+        else:
+            self._store = _NodeStore(stats=(self._new_stats() is not None))
+            self._app_subtotal = self._use_subtotal = 0
+            self._store.append(-1, _NodeStore.KIND_DIR, self._path, -1, -1)
+            frames = None
+        store = self._store
         app_leftover_bytes, use_leftover_bytes, new_fraction, keep_node = (
-            self._scan(self._path, self._tree, use_apparent_size))
+            self._scan(self._path, 0, use_apparent_size, frames))
         assert keep_node and not app_leftover_bytes, (
             keep_node, app_leftover_bytes, use_leftover_bytes)
+        if self._checkpoint and path.exists(self._checkpoint):
+            os.unlink(self._checkpoint)  # done, nothing to resume
+
+        _check_expected_size(
+            self._expected_size,
+            (self._use_subtotal, self._app_subtotal)[use_apparent_size],
+            self._detail)
+
+        # Only now create the DuNode objects, for the rows we kept.
+        self._tree = store.to_node()
+        self._store = self._stack = None
 
         # Do another prune run, since the fraction size has grown during the
-        # scan. Then merge nodes that couldn't get merged sooner.
+        # scan. Then merge nodes that couldn't get merged sooner, unless
+        # every leftover node should stay in its own directory.
         self._tree.prune_if_smaller_than(
             new_fraction, use_apparent_size)
-        self._tree.merge_upwards_if_smaller_than(
-            new_fraction, use_apparent_size)
+        if merge_upwards:
+            self._tree.merge_upwards_if_smaller_than(
+                new_fraction, use_apparent_size)
         return self._tree
 
-    def _scan(self, pathname, parent_node, a_or_u):
-        fraction = (  # initialize fraction
-            (self._use_subtotal, self._app_subtotal)[a_or_u] // 20)
-        children = []                        # large separate child nodes
+    def _get_options(self):
+        "Return the options that must match when resuming a checkpoint."
+        return {
+            'histogram': self._histogram, 'ages': self._ages,
+            'age_attr': self._age_attr, 'min_age': self._min_age,
+            'detail': self._detail, 'aggregate': sorted(self.aggregates),
+            'exclude': sorted(self._exclude), 'inodes': self._inodes}
+
+    @staticmethod
+    def load_checkpoint(filename):
+        "Read a checkpoint, to pass to scan(resume=...)."
+        with open(filename) as fp:
+            state = json.load(fp)
+        if state.get('dutree_checkpoint') != 1:
+            raise ValueError('Not a dutree checkpoint')
+        return state
+
+    def _write_checkpoint(self, a_or_u):
+        "Atomically replace the checkpoint file with the current state."
+        state = {
+            'dutree_checkpoint': 1,
+            'path': self._path,
+            'use_apparent_size': a_or_u,
+            'options': self._get_options(),
+            'store': self._store.as_dict(),
+            'stack': [
+                frame[0:3] + [frame[3] and frame[3].as_dict()] + frame[4:]
+                for frame in self._stack],
+            'app_subtotal': self._app_subtotal,
+            'use_subtotal': self._use_subtotal,
+            'min_fraction': self._min_fraction,
+            'aggregates': dict(
+                (key, [counter.top(), counter.error()])
+                for key, counter in self.aggregates.items()),
+            'errors': self.errors.as_dict(),
+        }
+        tmpname = self._checkpoint + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpname, self._checkpoint)  # atomic on POSIX
+        self._next_checkpoint = _monotonic() + self._checkpoint_interval
+
+    def _check_checkpoint(self, state, a_or_u):
+        "Raise ValueError if the checkpoint is of another kind of scan."
+        if state['path'] != self._path:
+            raise ValueError('Checkpoint was made of {0!r}'.format(
+                state['path'] or '/'))
+        if bool(state['use_apparent_size']) != bool(a_or_u):
+            raise ValueError('Checkpoint was made with other sizes')
+        options = self._get_options()
+        changed = sorted(
+            key for key in set(options) | set(state['options'])
+            if options.get(key) != state['options'].get(key))
+        if changed:
+            raise ValueError(
+                'Checkpoint was made with other options: {0}'.format(
+                    ', '.join(changed)))
+
+    def _restore_checkpoint(self, state, a_or_u):
+        "Load the scan state; return the frames to resume."
+        self._check_checkpoint(state, a_or_u)
+        self._store = _NodeStore.from_dict(state['store'])
+        self._app_subtotal = state['app_subtotal']
+        self._use_subtotal = state['use_subtotal']
+        self._min_fraction = state['min_fraction']
+        for key, (top, error) in state['aggregates'].items():
+            self.aggregates[key] = TopCounter.from_top(top, error)
+        self.errors = ScanErrors.from_dict(state['errors'])
+        return [
+            frame[0:3] + [frame[3] and DuStats.from_dict(frame[3])] +
+            frame[4:] for frame in state['stack']]
+
+    def _throttle(self):
+        "Wrap the listdir/lstat calls in the rate limiters, if any."
+        for limit, names in (
+                (self._max_iops, ('_lstat', '_listdir', '_scandir')),
+                (self._max_dirs_per_sec, ('_listdir', '_scandir'))):
+            if limit:
+                if not isinstance(limit, TokenBucket):
+                    limit = TokenBucket(limit)
+                for name in names:
+                    if getattr(self, name) is not None:
+                        setattr(self, name, limit.wrap(getattr(self, name)))
+
+    def _new_stats(self):
+        "Return new DuStats, or None if we don't collect any."
+        if self._histogram or self._ages:
+            return DuStats(histogram=self._histogram, ages=self._ages)
+        return None
+
+    def _get_fraction(self, a_or_u):
+        "Return the size below which files/dirs get no node of their own."
+        return max(
+            (self._use_subtotal, self._app_subtotal)[a_or_u] // self._detail,
+            self._min_fraction)
+
+    def _scan(self, pathname, row, a_or_u, resume=None):
+        fraction = self._get_fraction(a_or_u)  # initialize fraction
+        store = self._store
+        # The row moves if _force_prune compacts the store. The mixed
+        # totals, the name and the position in the listing are saved
+        # before descending into a subdirectory, for checkpoints.
+        if resume:
+            frame, resume = resume[0], resume[1:]
+        else:
+            frame = [row, 0, 0, self._new_stats(), 0, 0, None, 0]
+        self._stack.append(frame)
+        if self._checkpoint and _monotonic() >= self._next_checkpoint:
+            self._write_checkpoint(a_or_u)
 
+        # The listing is streamed: entries are stat'ed and dropped as
+        # they are read, so huge directories don't need huge lists.
         try:
-            files = listdir(pathname or '/')
+            if self._scandir is not None:
+                entries = self._scandir(pathname or '/')
+            else:
+                entries = self._listdir(pathname or '/')
         except OSError as e:
             # PermissionError: [Errno 13] Permission denied:
             #   '/sys/fs/fuse/connections/85'
-            warnings.warn(str(e), OsWarning)
+            self._add_error(e, pathname)
             app_mixed_total = 0
             use_mixed_total = 0
+            if resume:
+                self._drop_resume(pathname, resume)
         else:
-            files = [pathname + '/' + file_ for file_ in files]
-            app_mixed_total, use_mixed_total, fraction = (
-                self._scan_inner(files, children, fraction, a_or_u))
+            # Plain lstat scans get the paths right away: one generator
+            # less per entry.
+            entries = self._iter_entries(
+                pathname, entries,
+                as_paths=not (self._inodes or self._inode_order))
+            if frame[7]:
+                # Skip the entries done before the checkpoint.
+                entries = islice(entries, frame[7], None)
+            if self._inodes:
+                if self._scandir is None:
+                    entries = (
+                        _ListdirEntry(pathname, name, self._lstat)
+                        for name in entries)
+                app_mixed_total, use_mixed_total, fraction = (
+                    self._count_inner(
+                        pathname, entries, fraction, a_or_u, resume))
+            else:
+                if self._inode_order:
+                    files, lstat_ = self._stat_in_inode_order(
+                        pathname, entries)
+                else:
+                    files, lstat_ = entries, self._lstat
+                app_mixed_total, use_mixed_total, fraction = (
+                    self._scan_inner(
+                        pathname, files, fraction, a_or_u, lstat_, resume))
+
+        # Add whatever _force_prune merged into this node.
+        self._stack.pop()
+        row = frame[0]
+        app_mixed_total += frame[1]
+        use_mixed_total += frame[2]
+        stats = frame[3]
 
         # Do we have children or a total that's large enough: keep this
-        # node.
-        if children or (use_mixed_total, app_mixed_total)[a_or_u] >= fraction:
-            parent_node.add_branches(*children)
-            if children:
-                child_node = DuNode.new_leftovers(
-                    pathname, app_mixed_total, use_mixed_total)
-                parent_node.add_branches(child_node)
+        # node. All rows after ours are our (large separate) children.
+        # The root is always kept, even if a seeded fraction is too large.
+        has_children = (len(store) > row + 1)
+        if (has_children or not self._stack or
+                (use_mixed_total, app_mixed_total)[a_or_u] >= fraction):
+            if has_children:
+                row = store.append(
+                    row, store.KIND_REST, '*',
+                    app_mixed_total, use_mixed_total)
             else:
-                parent_node._set_size(app_mixed_total, use_mixed_total)
+                store.set_size(row, app_mixed_total, use_mixed_total)
+            if stats is not None:
+                store.stats[row] = stats
             app_mixed_total = use_mixed_total = 0
             keep_node = True
         else:
+            store.truncate(row)
+            if stats is not None:
+                self._stack[-1][3].merge(stats)
             keep_node = False
 
         # Leftovers, the new fraction and whether to keep the child.
         return app_mixed_total, use_mixed_total, fraction, keep_node
 
-    def _scan_inner(self, files, children, fraction, a_or_u):
-        app_mixed_total = 0  # "rest of the dir", add to this node
-        use_mixed_total = 0
+    def _iter_entries(self, pathname, entries, as_paths=False):
+        """Yield the entries as they are read; record a read error.
 
-        for file_ in files:
+        With as_paths, yield the paths of the (scandir or listdir)
+        entries instead.
+        """
+        try:
+            if not as_paths:
+                for entry in entries:
+                    yield entry
+            elif self._scandir is not None:
+                prefix = pathname + '/'
+                for entry in entries:
+                    yield prefix + entry.name
+            else:
+                prefix = pathname + '/'
+                for name in entries:
+                    yield prefix + name
+        except OSError as e:
+            self._add_error(e, pathname)
+        finally:
+            close = getattr(entries, 'close', None)
+            if close is not None:
+                close()  # the scandir() fd
+
+    def _drop_resume(self, pathname, resume):
+        "Drop the subdirectory that was being scanned at the checkpoint."
+        warnings.warn(
+            '{0!r} changed since the checkpoint, its size may be off'.format(
+                pathname or '/'), OsWarning)
+        self._store.truncate(resume[0][0])
+
+    def _stat_in_inode_order(self, pathname, entries):
+        """Stat the entries in inode number order, a window at a time.
+
+        Return an iterator over the paths in directory order and a
+        lookup function for their stat results. On spinning disks,
+        stat'ing in directory order seeks all over the inode table.
+        Sorting windows of INODE_WINDOW entries keeps the memory bounded
+        in huge directories. The results are still consumed in directory
+        order, so the scan result does not change.
+        """
+        lstat_ = self._lstat
+        results = {}
+
+        def files():
+            while True:
+                window = [
+                    (entry.inode(), pathname + '/' + entry.name)
+                    for entry in islice(entries, self.INODE_WINDOW)]
+                if not window:
+                    return
+                for inode, file_ in sorted(window):
+                    try:
+                        results[file_] = lstat_(file_)
+                    except OSError as e:
+                        results[file_] = e
+                for inode, file_ in window:
+                    yield file_
+
+        def lstat_cached(file_):
+            st = results.pop(file_)
+            if isinstance(st, OSError):
+                raise st
+            return st
+        return files(), lstat_cached
+
+    def _scan_inner(self, pathname, files, fraction, a_or_u, lstat_,
+                    resume=None):
+        prefix_len = len(pathname) + 1
+        store = self._store
+        frame = self._stack[-1]
+        # "Rest of the dir", add to this node. Not 0 when resuming.
+        app_mixed_total, use_mixed_total = frame[4], frame[5]
+        stats = frame[3]
+        aggregates = self.aggregates
+        check_age = bool(self._ages or self._min_age)
+        age_attr, min_age, now = self._age_attr, self._min_age, self._now
+        age_bucket = 0
+        checkpoint = self._checkpoint
+        # Locals: this loop runs for every entry. The min_fraction local
+        # is refreshed whenever a _force_prune() may have raised it.
+        detail, max_nodes = self._detail, self._max_nodes
+        min_fraction = self._min_fraction
+
+        for index, file_ in enumerate(files, frame[7]):
             try:
-                st = lstat(file_)
+                st = lstat_(file_)
             except OSError as e:
                 # Could be deleted:
                 #   [Errno 2] No such file or directory: '/proc/14532/fdinfo/3'
                 # Could be EPERM:
                 #   [Errno 13] Permission denied: '/run/user/1000/gvfs'
-                warnings.warn(str(e), OsWarning)
+                self._add_error(e, file_)
                 continue
 
+            if resume and (file_[prefix_len:] != frame[6] or
+                           not S_ISDIR(st.st_mode)):
+                # Not the subdirectory we were in at the checkpoint.
+                self._drop_resume(pathname, resume)
+                resume = None
+
+            if check_age:
+                age = now - getattr(st, age_attr)
+                age_bucket = AgeBuckets.get_bucket(age)
+                if min_age and age < min_age:
+                    # Not stale: skip it, but do look inside directories.
+                    if S_ISDIR(st.st_mode):
+                        frame[4:8] = (
+                            app_mixed_total, use_mixed_total,
+                            file_[prefix_len:], index)
+                        fraction = self._scan_dir(
+                            file_, prefix_len, fraction, a_or_u, resume)[2]
+                        resume = None
+                        min_fraction = self._min_fraction
+                    continue
+
+            if aggregates:
+                self._aggregate(st, file_[prefix_len:], a_or_u)
+
             if S_ISREG(st.st_mode):
                 if st.st_blocks == 0:
                     # Pseudo-files, like the one in /proc have 0-block
@@ -404,30 +1863,42 @@ class DuScan:
                     use_size = st.st_blocks << 9
 
                 if (use_size, app_size)[a_or_u] >= fraction:
-                    child_node = DuNode.new_file(file_, app_size, use_size)
-                    children.append(child_node)
-                    self._app_subtotal += child_node.app_size()
-                    self._use_subtotal += child_node.use_size()
+                    row = store.append(
+                        frame[0], store.KIND_FILE, file_[prefix_len:],
+                        app_size, use_size)
+                    if stats is not None:
+                        store.stats[row] = file_stats = self._new_stats()
+                        file_stats.add_file(
+                            app_size, (use_size, app_size)[a_or_u],
+                            age_bucket)
+                    if max_nodes and len(store) > max_nodes:
+                        self._force_prune(a_or_u)
+                        min_fraction = self._min_fraction
                 else:
                     # The file is too small and it doesn't get its own
                     # node. Count it on this node.
                     app_mixed_total += app_size
                     use_mixed_total += use_size
-                    self._app_subtotal += app_size
-                    self._use_subtotal += use_size
+                    if stats is not None:
+                        stats.add_file(
+                            app_size, (use_size, app_size)[a_or_u],
+                            age_bucket)
+                self._app_subtotal += app_size
+                self._use_subtotal += use_size
 
             elif S_ISDIR(st.st_mode):
-                child_node = DuNode.new_dir(file_)
-
-                app_leftover_bytes, use_leftover_bytes, fraction, keep_node = (
-                    self._scan(file_, child_node, a_or_u))
-                if keep_node:
-                    assert not app_leftover_bytes, (
-                        app_leftover_bytes, use_leftover_bytes)
-                    children.append(child_node)
-                else:
-                    app_mixed_total += app_leftover_bytes
-                    use_mixed_total += use_leftover_bytes
+                frame[4:8] = (
+                    app_mixed_total, use_mixed_total, file_[prefix_len:],
+                    index)
+                app_leftover_bytes, use_leftover_bytes, fraction = (
+                    self._scan_dir(
+                        file_, prefix_len, fraction, a_or_u, resume))
+                resume = None
+                if max_nodes and len(store) > max_nodes:
+                    self._force_prune(a_or_u)
+                min_fraction = self._min_fraction
+                app_mixed_total += app_leftover_bytes
+                use_mixed_total += use_leftover_bytes
 
                 # Also count the directory listing size to get the same
                 # total as `du -sb`. Note that du is about 1/3 faster,
@@ -439,6 +1910,9 @@ class DuScan:
                 use_mixed_total += st.st_blocks << 9
                 self._app_subtotal += st.st_size
                 self._use_subtotal += st.st_blocks << 9
+                if stats is not None:
+                    stats.add_other(
+                        (st.st_blocks << 9, st.st_size)[a_or_u], age_bucket)
 
             else:
                 # Also count the whatever-file-this-may-be size (symlink?).
@@ -446,13 +1920,1291 @@ class DuScan:
                 use_mixed_total += st.st_blocks << 9
                 self._app_subtotal += st.st_size
                 self._use_subtotal += st.st_blocks << 9
+                if stats is not None:
+                    stats.add_other(
+                        (st.st_blocks << 9, st.st_size)[a_or_u], age_bucket)
 
-            # Recalculate fraction based on updated subtotal.
+            # Recalculate fraction based on updated subtotal, like
+            # _get_fraction() does.
             fraction = (
-                (self._use_subtotal, self._app_subtotal)[a_or_u] // 20)
-
+                (self._use_subtotal, self._app_subtotal)[a_or_u] // detail)
+            if fraction < min_fraction:
+                fraction = min_fraction
+
+            if (checkpoint and not (index + 1) % self.CHECKPOINT_EVERY and
+                    _monotonic() >= self._next_checkpoint):
+                # Also save the state while in a huge flat directory.
+                frame[4:8] = (
+                    app_mixed_total, use_mixed_total, None, index + 1)
+                self._write_checkpoint(a_or_u)
+
+        if resume:
+            self._drop_resume(pathname, resume)
         return app_mixed_total, use_mixed_total, fraction
 
+    def _count_inner(self, pathname, entries, fraction, a_or_u, resume=None):
+        """Like _scan_inner, but count the entries of the directory.
+
+        The file type from the directory listing (d_type) tells which
+        entries to descend into, so nothing is lstat()'ed. A single file
+        is a single inode, so files never get a node of their own. Both
+        the apparent and the used size are the count.
+        """
+        prefix_len = len(pathname) + 1
+        frame = self._stack[-1]
+        mixed_total = frame[4]  # not 0 when resuming
+        checkpoint = self._checkpoint
+
+        for index, entry in enumerate(entries, frame[7]):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError as e:
+                self._add_error(e, pathname + '/' + entry.name)
+                continue
+
+            if resume and (entry.name != frame[6] or not is_dir):
+                # Not the subdirectory we were in at the checkpoint.
+                self._drop_resume(pathname, resume)
+                resume = None
+
+            if is_dir:
+                frame[4:8] = (mixed_total, mixed_total, entry.name, index)
+                leftover_count, _, fraction = self._scan_dir(
+                    pathname + '/' + entry.name, prefix_len, fraction,
+                    a_or_u, resume)
+                resume = None
+                mixed_total += leftover_count
+
+            # The entry itself, like du --inodes.
+            mixed_total += 1
+            self._app_subtotal += 1
+            self._use_subtotal += 1
+
+            if self._max_nodes and len(self._store) > self._max_nodes:
+                self._force_prune(a_or_u)
+
+            # Recalculate fraction based on updated subtotal.
+            fraction = self._get_fraction(a_or_u)
+
+            if (checkpoint and not (index + 1) % self.CHECKPOINT_EVERY and
+                    _monotonic() >= self._next_checkpoint):
+                frame[4:8] = (mixed_total, mixed_total, None, index + 1)
+                self._write_checkpoint(a_or_u)
+
+        if resume:
+            self._drop_resume(pathname, resume)
+        return mixed_total, mixed_total, fraction
+
+    def _scan_dir(self, file_, prefix_len, fraction, a_or_u, resume=None):
+        "Scan subdirectory file_; return leftover bytes and new fraction."
+        if file_ in self._exclude:
+            return 0, 0, fraction
+        if resume:
+            child_row = resume[0][0]  # already added before the checkpoint
+        else:
+            store = self._store
+            child_row = store.append(
+                self._stack[-1][0], store.KIND_DIR, file_[prefix_len:],
+                -1, -1)
+
+        app_leftover_bytes, use_leftover_bytes, fraction, keep_node = (
+            self._scan(file_, child_row, a_or_u, resume))
+        if keep_node:
+            assert not app_leftover_bytes, (
+                app_leftover_bytes, use_leftover_bytes)
+        return app_leftover_bytes, use_leftover_bytes, fraction
+
+    def _add_error(self, e, pathname):
+        "Record the OSError for pathname; warn right away if verbose."
+        topdir = pathname[len(self._path) + 1:].split('/', 1)[0]
+        self.errors.add(e, pathname or '/', self._path + '/' + topdir)
+        if self._verbose:
+            warnings.warn(str(e), OsWarning)
+
+    def _aggregate(self, st, name, a_or_u):
+        "Add the file to the uid/gid/ext counters."
+        is_reg = S_ISREG(st.st_mode)
+        if is_reg and st.st_blocks == 0:
+            return  # pseudo-file, see _scan_inner
+
+        size = (st.st_blocks << 9, st.st_size)[a_or_u]
+        for key, counter in self.aggregates.items():
+            if key == 'uid':
+                counter.add(st.st_uid, size)
+            elif key == 'gid':
+                counter.add(st.st_gid, size)
+            elif is_reg:
+                dot = name.rfind('.')
+                counter.add((name[dot + 1:].lower() if dot > 0 else ''), size)
+
+    def _force_prune(self, a_or_u):
+        """Raise the minimum fraction until the store is back at half its
+        node budget.
+
+        This trades precision for memory: whatever gets merged now can
+        not show up separately when the fraction would've stayed small.
+        """
+        store = self._store
+        subtotal = (self._use_subtotal, self._app_subtotal)[a_or_u]
+        small_size = max(self._get_fraction(a_or_u), 1)
+        while True:
+            store.compact(small_size, self._stack, a_or_u)
+            if len(store) <= self._max_nodes // 2 or small_size > subtotal:
+                break
+            small_size *= 2
+        self._min_fraction = small_size
+
+
+def _seed_fraction(expected_size, detail):
+    """Return the starting fraction for a tree of about expected_size.
+
+    Only half of the final fraction is used, so a tree that turns out a
+    bit smaller than expected still gets all its nodes of at least
+    1/detail of the total.
+    """
+    if not expected_size:
+        return 0
+    return expected_size // detail // 2
+
+
+def _check_expected_size(expected_size, total, detail):
+    "Warn if the seeded fraction was too large for the real total."
+    seed = _seed_fraction(expected_size, detail)
+    if seed > total // detail:
+        warnings.warn(
+            'Expected {0} but found {1}; paths smaller than {2} may be '
+            'missing from the result'.format(
+                human(expected_size), human(total), human(seed)),
+            OsWarning)
+
+
+def get_statvfs_used(pathname, inodes=False):
+    """Return the bytes (or inodes) in use on the filesystem mounted at
+    pathname.
+
+    Returns None if pathname is not a mount point, since then the used
+    bytes say little about the size of the tree.
+    """
+    if not hasattr(os, 'statvfs') or not path.ismount(pathname or '/'):
+        return None
+    st = os.statvfs(pathname or '/')
+    if inodes:
+        return st.f_files - st.f_ffree
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def get_mount_points():
+    "Return the mount points of this (Linux) host, or [] if unknown."
+    try:
+        with open('/proc/self/mounts') as fp:
+            lines = fp.read().splitlines()
+    except (IOError, OSError):
+        return []
+    # Spaces and such are octal escaped: "/mnt/my\\040disk"
+    return [
+        re.sub(r'\\([0-7]{3})', (lambda m: chr(int(m.group(1), 8))),
+               line.split()[1])
+        for line in lines if len(line.split()) > 2]
+
+
+class DeviceScheduler(object):
+    """Run work concurrently, with a separate job limit per device
+
+    All work for a single device (st_dev) is done by that device's own
+    threads, so a slow spindle doesn't hold up the NVMe or NFS mounts,
+    and isn't overloaded either. Rotational disks get a single job,
+    unless configured otherwise. The threads mostly wait for I/O, which
+    doesn't hold the GIL.
+    """
+    def __init__(self, default_jobs=8, jobs=None):
+        self._default_jobs = default_jobs
+        self._jobs = dict(jobs or {})  # st_dev => number of jobs
+
+    def get_jobs(self, dev):
+        "Return the job limit for the device."
+        if dev in self._jobs:
+            return self._jobs[dev]
+        if self._is_rotational(dev):
+            return 1
+        return self._default_jobs
+
+    @staticmethod
+    def _is_rotational(dev):
+        sysfs = '/sys/dev/block/{0}:{1}'.format(os.major(dev), os.minor(dev))
+        # Partitions don't have a queue dir; their parent disk does.
+        for queue in (sysfs + '/queue', sysfs + '/../queue'):
+            try:
+                with open(queue + '/rotational') as fp:
+                    return fp.read().strip() == '1'
+            except (IOError, OSError):
+                pass
+        return False
+
+    def run(self, func, work):
+        """Call func(arg) for every (dev, arg) in work; return the results.
+
+        The results are in the order of work. The first exception is
+        raised after all threads are done.
+        """
+        results = [None] * len(work)
+        errors = []
+        queues = {}
+        for index, (dev, arg) in enumerate(work):
+            queues.setdefault(dev, []).append((index, arg))
+
+        def worker(queue):
+            while not errors:
+                try:
+                    index, arg = queue.pop(0)  # list.pop is thread-safe
+                except IndexError:
+                    break
+                try:
+                    results[index] = func(arg)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = []
+        for dev, queue in queues.items():
+            for i in range(min(self.get_jobs(dev), len(queue))):
+                thread = threading.Thread(target=worker, args=(queue,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+class ParallelDuScan(object):
+    """Disk Usage Tree scanner running separate scans concurrently
+
+    The tree is split into work units: the directories at split_depth
+    and all mount points below the path. Each unit is scanned by its
+    own DuScan, which skips the other units, on the DeviceScheduler.
+    The unit trees are then grafted together and pruned at 5% of the
+    grand total, like a single scan would have been.
+
+    The totals are exact. Because each unit starts with an empty
+    fraction (or the one seeded by expected_size for the whole tree),
+    the units keep a bit more detail during the scan, so the leaves can
+    differ slightly from those of a single DuScan.
+    """
+    def __init__(self, pathname, scheduler=None, split_depth=1,
+                 mount_points=None, **kwargs):
+        self._backend = kwargs.get('backend') or LocalBackend()
+        if getattr(self._backend, 'streaming', False):
+            raise ValueError('Cannot scan a streaming backend in parallel')
+        if kwargs.get('checkpoint'):
+            raise ValueError('Cannot checkpoint a parallel scan')
+        kwargs['backend'] = self._backend
+        # This is the size of the whole tree, not of the units.
+        self._expected_size = kwargs.pop('expected_size', None)
+        # The units share the rate limits.
+        for key in ('max_iops', 'max_dirs_per_sec'):
+            if kwargs.get(key) and not isinstance(kwargs[key], TokenBucket):
+                kwargs[key] = TokenBucket(kwargs[key])
+        self._kwargs = kwargs
+        self._path = DuScan(pathname, **kwargs)._path  # checks it too
+        self._scheduler = scheduler or DeviceScheduler()
+        self._split_depth = split_depth
+        if mount_points is None:
+            mount_points = get_mount_points()
+        self._mount_points = mount_points
+        self.aggregates = dict(
+            (key, TopCounter()) for key in kwargs.get('aggregate', ()))
+        self.errors = ScanErrors()
+
+    def _get_units(self):
+        "Return (dev, path) tuples of the separately scanned directories."
+        units = []
+        self._find_units(self._path, 0, units)
+        found = set(path_ for dev, path_ in units)
+        prefix = self._path + '/'
+        for mount_point in self._mount_points:
+            if (mount_point.startswith(prefix) and
+                    mount_point != prefix and mount_point not in found):
+                try:
+                    st = self._backend.lstat(mount_point)
+                except OSError:
+                    continue
+                if S_ISDIR(st.st_mode):
+                    units.append((getattr(st, 'st_dev', 0), mount_point))
+        return units
+
+    def _find_units(self, pathname, depth, units):
+        if depth == self._split_depth:
+            return
+        try:
+            names = list(self._backend.listdir(pathname or '/'))
+        except OSError:
+            return  # the scan of the parent will record it
+        for name in names:
+            child = pathname + '/' + name
+            try:
+                st = self._backend.lstat(child)
+            except OSError:
+                continue
+            if S_ISDIR(st.st_mode):
+                if depth + 1 == self._split_depth:
+                    units.append((getattr(st, 'st_dev', 0), child))
+                else:
+                    self._find_units(child, depth + 1, units)
+
+    def scan(self, use_apparent_size=True, merge_upwards=True, resume=None):
+        if resume:
+            raise ValueError('Cannot resume a parallel scan')
+        units = self._get_units()
+        try:
+            top_dev = self._backend.lstat(self._path or '/').st_dev
+        except (AttributeError, OSError):
+            top_dev = 0
+        results = self._scan_units(
+            [(top_dev, self._path or '/')] + units, use_apparent_size)
+
+        tree = results[0][2]
+        if tree is None:
+            tree = DuNode.new_dir(self._path)  # the top unit failed
+        for errors, aggregates, unit_tree in results:
+            self.errors.merge(errors)
+            for key, counter in aggregates.items():
+                self.aggregates[key].merge(counter)
+            if unit_tree is tree or unit_tree is None:
+                continue
+            parent_node = tree
+            for name in unit_tree._name[len(self._path) + 1:].split('/'):
+                parent_node = parent_node._get_branch(name)
+            parent_node._merge(unit_tree)
+
+        total = tree.app_size() if use_apparent_size else tree.use_size()
+        _check_expected_size(
+            self._expected_size, total, self._kwargs.get('detail', 20))
+        small_size = total // self._kwargs.get('detail', 20)
+        tree.prune_if_smaller_than(small_size, use_apparent_size)
+        if merge_upwards:
+            tree.merge_upwards_if_smaller_than(small_size, use_apparent_size)
+        return tree
+
+    def _scan_units(self, units, use_apparent_size):
+        """Scan the (dev, path) units, each skipping the others.
+
+        Return (errors, aggregates, tree) tuples, in the order of units.
+        The tree is None for a unit that could not be scanned at all.
+        """
+        exclude = [path_ for dev, path_ in units[1:]]
+
+        def scan_unit(pathname):
+            scanner = DuScan(pathname, exclude=exclude, **self._kwargs)
+            scanner._min_fraction = _seed_fraction(
+                self._expected_size, self._kwargs.get('detail', 20))
+            tree = scanner.scan(use_apparent_size=use_apparent_size)
+            return scanner.errors, scanner.aggregates, tree
+
+        return self._scheduler.run(scan_unit, units)
+
+
+class ShardedDuScan(ParallelDuScan):
+    """Disk Usage Tree scanner handing out work units to worker hosts
+
+    The work units of ParallelDuScan become shards in a file based queue
+    in queue_dir, which all workers must be able to reach; a directory
+    on the scanned filesystem itself will do. Each ShardWorker ("dutree
+    worker QUEUE") claims shards by renaming them, scans them and writes
+    back the pruned tree. The workers must see the tree at the same
+    path. The trees are grafted together like ParallelDuScan does.
+
+    A shard whose claim wasn't touched for stale_after seconds, because
+    its worker died, is handed out again. A shard that keeps failing is
+    given up on, and counted in the errors. With local_workers, that
+    many worker processes are started here as well; if all of those die
+    while shards are left, the scan is aborted.
+    """
+    # DuScan options that are passed on to the workers.
+    OPTIONS = (
+        'engine', 'dont_sync', 'max_nodes', 'histogram', 'aggregate', 'ages',
+        'use_atime', 'min_age', 'detail', 'inode_order', 'max_iops',
+        'max_dirs_per_sec', 'inodes')
+
+    def __init__(self, pathname, queue_dir, split_depth=1, mount_points=None,
+                 local_workers=0, poll_interval=1, stale_after=600,
+                 **kwargs):
+        if kwargs.get('backend'):
+            raise ValueError('Sharded scans use the filesystem of the workers')
+        self._options = dict(
+            (key, value) for key, value in kwargs.items()
+            if key in self.OPTIONS and value is not None)
+        super(ShardedDuScan, self).__init__(
+            pathname, split_depth=split_depth, mount_points=mount_points,
+            **kwargs)
+        self._queue = ShardQueue(queue_dir)
+        self._local_workers = local_workers
+        self._poll_interval = poll_interval
+        self._stale_after = stale_after
+
+    def _scan_units(self, units, use_apparent_size):
+        self._queue.create({
+            'path': self._path,
+            'use_apparent_size': use_apparent_size,
+            'exclude': [path_ for dev, path_ in units[1:]],
+            'options': self._options,
+            'min_fraction': _seed_fraction(
+                self._expected_size, self._options.get('detail', 20)),
+            'heartbeat': self._stale_after / 4.0,
+        }, [path_ for dev, path_ in units])
+
+        workers = []
+        for i in range(self._local_workers):
+            worker = multiprocessing.Process(
+                target=ShardWorker(self._queue.directory).run)
+            worker.start()
+            workers.append(worker)
+        try:
+            while not self._queue.is_done():
+                if (workers and self._queue.has_todo() and
+                        not any(worker.is_alive() for worker in workers)):
+                    self._queue.remove()
+                    raise OSError(
+                        'All local shard workers died, the scan of {0!r} '
+                        'is incomplete'.format(self._path or '/'))
+                self._queue.requeue_stale(self._stale_after)
+                time.sleep(self._poll_interval)
+        finally:
+            for worker in workers:
+                worker.join()
+
+        results = []
+        for result in self._queue.get_results():
+            results.append((
+                ScanErrors.from_dict(result['errors']),
+                dict((key, TopCounter.from_top(top, error))
+                     for key, (top, error) in result['aggregates'].items()),
+                result['tree'] and DuNode.from_dict(result['tree'])))
+        self._queue.remove()
+        return results
+
+
+class ShardQueue(object):
+    """Queue of scan shards, in a directory shared by the workers
+
+    The manifest.json holds the scan options. Each shard is a file in
+    todo/, claimed by renaming it into claimed/ (which is atomic, also
+    on NFS), and its result is renamed into done/ when written.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._manifest = None
+
+    def _path(self, *names):
+        return path.join(self.directory, *names)
+
+    def create(self, manifest, shard_paths):
+        "Write the manifest and a todo file per shard."
+        if path.exists(self._path('manifest.json')):
+            raise ValueError(
+                'Shard queue {0!r} is in use'.format(self.directory))
+        for name in ('todo', 'claimed', 'done'):
+            os.makedirs(self._path(name))
+        for shard, shard_path in enumerate(shard_paths):
+            self._write(
+                self._path('todo', '{0:06d}.json'.format(shard)),
+                {'shard': shard, 'path': shard_path})
+        manifest = dict(manifest, dutree_shards=1, shards=len(shard_paths))
+        self._write(self._path('manifest.json'), manifest)  # last
+
+    @staticmethod
+    def _write(filename, data):
+        "Write data as JSON to filename, atomically."
+        tmpname = '{0}.{1}.{2}.tmp'.format(
+            filename, socket.gethostname(), os.getpid())
+        with open(tmpname, 'w') as fp:
+            json.dump(data, fp)
+        os.rename(tmpname, filename)
+
+    def get_manifest(self):
+        "Return the manifest, or None if there is no queue (yet)."
+        if self._manifest is None:
+            try:
+                with open(self._path('manifest.json')) as fp:
+                    self._manifest = json.load(fp)
+            except (IOError, OSError):
+                return None
+        return self._manifest
+
+    def claim(self):
+        "Return the claimed shard name, or None if there is nothing to do."
+        try:
+            names = sorted(os.listdir(self._path('todo')))
+        except OSError:
+            return None  # removed, all done
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                os.rename(
+                    self._path('todo', name), self._path('claimed', name))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue  # another worker was first
+                raise
+            return name
+        return None
+
+    def get_shard(self, name):
+        with open(self._path('claimed', name)) as fp:
+            return json.load(fp)
+
+    def touch(self, name):
+        "Show that the worker of the claimed shard is still alive."
+        try:
+            os.utime(self._path('claimed', name), None)
+        except OSError:
+            pass  # requeued or done
+
+    def release(self, name):
+        "Hand the claimed shard out again."
+        try:
+            os.rename(self._path('claimed', name), self._path('todo', name))
+        except OSError:
+            pass
+
+    def fail(self, name, e, max_failures):
+        """Hand the claimed shard out again after an error.
+
+        After max_failures errors, store a result without a tree, with
+        the error counted in its errors.
+        """
+        try:
+            shard = self.get_shard(name)
+        except (IOError, OSError):
+            return  # requeued meanwhile
+        shard['failures'] = shard.get('failures', 0) + 1
+        if shard['failures'] < max_failures:
+            self._write(self._path('claimed', name), shard)
+            self.release(name)
+            return
+        errors = ScanErrors()
+        errors.add(
+            # Not None: by_errno can't sort that among the numbers.
+            OSError(getattr(e, 'errno', None) or errno.EIO,
+                    getattr(e, 'strerror', None) or str(e)),
+            shard['path'], shard['path'])
+        self.finish(name, {
+            'shard': shard['shard'],
+            'host': socket.gethostname(),
+            'tree': None,
+            'aggregates': {},
+            'errors': errors.as_dict(),
+        })
+
+    def finish(self, name, result):
+        "Store the result of the claimed shard."
+        try:
+            self._write(self._path('done', name), result)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return  # the coordinator gave up and removed the queue
+        try:
+            os.unlink(self._path('claimed', name))
+        except OSError:
+            pass  # done twice, after a requeue
+
+    def requeue_stale(self, stale_after):
+        "Hand out the shards again whose workers seem to have died."
+        now = time.time()
+        for name in os.listdir(self._path('claimed')):
+            try:
+                if os.stat(self._path('claimed', name)).st_mtime < (
+                        now - stale_after):
+                    self.release(name)
+            except OSError:
+                pass  # finished meanwhile
+
+    def has_todo(self):
+        "Return True if there are shards waiting for a worker."
+        try:
+            names = os.listdir(self._path('todo'))
+        except OSError:
+            return False
+        return any(name.endswith('.json') for name in names)
+
+    def is_done(self):
+        try:
+            names = os.listdir(self._path('done'))
+        except OSError:
+            return True  # removed by the coordinator
+        done = [name for name in names if name.endswith('.json')]
+        return len(done) == self.get_manifest()['shards']
+
+    def get_results(self):
+        "Return the results, in shard order."
+        for name in sorted(os.listdir(self._path('done'))):
+            if name.endswith('.json'):
+                with open(self._path('done', name)) as fp:
+                    yield json.load(fp)
+
+    def remove(self):
+        "Remove the queue files, keeping the directory itself."
+        os.unlink(self._path('manifest.json'))
+        for name in ('todo', 'claimed', 'done'):
+            shutil.rmtree(self._path(name))
+
+
+class ShardWorker(object):
+    """Worker scanning the shards of a ShardedDuScan
+
+    Run this on every client host that should help, with the same
+    queue_dir. It scans shards until all are done, waiting up to
+    wait seconds for the queue to show up. A shard that fails is handed
+    out again, up to MAX_FAILURES times in total.
+    """
+    MAX_FAILURES = 3
+
+    def __init__(self, queue_dir, wait=60, poll_interval=1):
+        self._queue = ShardQueue(queue_dir)
+        self._wait = wait
+        self._poll_interval = poll_interval
+
+    def run(self):
+        "Scan shards until there are no more; return how many."
+        deadline = _monotonic() + self._wait
+        while self._queue.get_manifest() is None:
+            if _monotonic() > deadline:
+                raise OSError(
+                    'No shard queue in {0!r}'.format(self._queue.directory))
+            time.sleep(self._poll_interval)
+        done = 0
+        while True:
+            name = self._queue.claim()
+            if name is not None:
+                if self._scan_shard(name):
+                    done += 1
+            elif self._queue.is_done():
+                return done
+            else:
+                # Others are busy; their shards may get requeued.
+                time.sleep(self._poll_interval)
+
+    def _scan_shard(self, name):
+        "Scan the claimed shard; return whether that succeeded."
+        queue = self._queue
+        manifest = queue.get_manifest()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(manifest['heartbeat']):
+                queue.touch(name)
+
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        try:
+            shard = queue.get_shard(name)
+            scanner = DuScan(
+                shard['path'], exclude=manifest['exclude'],
+                **manifest['options'])
+            scanner._min_fraction = manifest['min_fraction']
+            tree = scanner.scan(manifest['use_apparent_size'])
+        except Exception as e:
+            # Like a shard directory that vanished since it was queued.
+            warnings.warn('Shard {0} failed: {1}'.format(name, e), OsWarning)
+            queue.fail(name, e, self.MAX_FAILURES)
+            return False
+        except BaseException:
+            queue.release(name)
+            raise
+        finally:
+            stop.set()
+            thread.join()
+        queue.finish(name, {
+            'shard': shard['shard'],
+            'host': socket.gethostname(),
+            'tree': tree.as_dict(),
+            'aggregates': dict(
+                (key, [counter.top(), counter.error()])
+                for key, counter in scanner.aggregates.items()),
+            'errors': scanner.errors.as_dict(),
+        })
+        return True
+
+
+def _own_size(st):
+    "Return the (apparent, used) size the scan counts for an entry."
+    if S_ISREG(st.st_mode) and st.st_blocks == 0:
+        return 0, 0  # pseudo-file, see DuScan._scan_inner
+    return st.st_size, st.st_blocks << 9
+
+
+def _get_libc():
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def _raise_errno(what):
+    errno_ = ctypes.get_errno()
+    raise OSError(errno_, '{0}: {1}'.format(what, os.strerror(errno_)))
+
+
+def _read_all(fd, timeout):
+    "Wait up to timeout seconds for fd; return all that can be read."
+    if not select.select([fd], [], [], timeout)[0]:
+        return b''
+    chunks = []
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class InotifyWatcher(object):
+    """Report changed directories using Linux inotify(7)
+
+    inotify needs a watch on every directory: the LiveTree calls add()
+    before listing one. Watches on removed directories go away by
+    themselves. Mind the fs.inotify.max_user_watches sysctl.
+    """
+    IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x40, 0x80
+    IN_CREATE, IN_DELETE = 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED = 0x4000, 0x8000
+    IN_ONLYDIR, IN_DONT_FOLLOW = 0x1000000, 0x2000000
+    IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000  # not in python2 os
+    MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        self._libc = _get_libc()
+        self._fd = self._libc.inotify_init1(
+            self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            _raise_errno('inotify_init1')
+        self._paths = {}  # watch descriptor => path
+
+    def add(self, pathname):
+        "Watch the entries of directory pathname."
+        wd = self._libc.inotify_add_watch(
+            self._fd, _fsencode(pathname or '/'),
+            self.MASK | self.IN_ONLYDIR | self.IN_DONT_FOLLOW)
+        if wd < 0:
+            _raise_errno('inotify_add_watch {0!r}'.format(pathname))
+        self._paths[wd] = pathname
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events.
+
+        Return the set of directories with changed entries, or None if
+        events were lost.
+        """
+        data = _read_all(self._fd, timeout)
+        dirs = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & self.IN_IGNORED:
+                self._paths.pop(wd, None)
+            elif wd in self._paths:
+                dirs.add(self._paths[wd])
+        return None if overflow else dirs
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FanotifyWatcher(object):
+    """Report changed directories using Linux fanotify(7)
+
+    A single mark covers the whole filesystem holding pathname, so no
+    watches need to be added. This needs CAP_SYS_ADMIN (to mark) and
+    CAP_DAC_READ_SEARCH (to turn the reported directory handles into
+    paths), and Linux 5.9 or later. Directories below pathname that are
+    mounted from other filesystems are not watched.
+    """
+    FAN_CLASS_NOTIF, FAN_CLOEXEC, FAN_NONBLOCK = 0, 0x1, 0x2
+    FAN_REPORT_DFID_NAME = 0xc00
+    FAN_MARK_ADD, FAN_MARK_FILESYSTEM = 0x1, 0x100
+    FAN_MODIFY, FAN_MOVED_FROM, FAN_MOVED_TO = 0x2, 0x40, 0x80
+    FAN_CREATE, FAN_DELETE = 0x100, 0x200
+    FAN_Q_OVERFLOW, FAN_ONDIR = 0x4000, 0x40000000
+    FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+    O_PATH = 0o10000000  # not in python2 os
+    MASK = (FAN_MODIFY | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE |
+            FAN_DELETE | FAN_ONDIR)
+    EVENT = struct.Struct('IBBHQii')  # fanotify_event_metadata
+    INFO = struct.Struct('BBH8sI')  # header, fsid, handle_bytes
+
+    def __init__(self, pathname):
+        self._libc = _get_libc()
+        self._libc.fanotify_mark.argtypes = (
+            ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int,
+            ctypes.c_char_p)
+        self._fd = self._libc.fanotify_init(
+            self.FAN_CLASS_NOTIF | self.FAN_CLOEXEC | self.FAN_NONBLOCK |
+            self.FAN_REPORT_DFID_NAME, os.O_RDONLY)
+        if self._fd < 0:
+            _raise_errno('fanotify_init')
+        if self._libc.fanotify_mark(
+                self._fd, self.FAN_MARK_ADD | self.FAN_MARK_FILESYSTEM,
+                self.MASK, -1, _fsencode(pathname or '/')) != 0:
+            os.close(self._fd)
+            _raise_errno('fanotify_mark {0!r}'.format(pathname))
+        # Directory handles are resolved relative to this.
+        self._mount_fd = os.open(pathname or '/', os.O_RDONLY)
+
+    def add(self, pathname):
+        "Nothing to do; the mark covers the whole filesystem."
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events.
+
+        Return the set of directories with changed entries, or None if
+        events were lost.
+        """
+        data = _read_all(self._fd, timeout)
+        handles = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            event_len, vers, reserved, metadata_len, mask, fd, pid = (
+                self.EVENT.unpack_from(data, offset))
+            if mask & self.FAN_Q_OVERFLOW:
+                overflow = True
+            info = offset + metadata_len
+            while info < offset + event_len:
+                info_type, pad, length, fsid, handle_bytes = (
+                    self.INFO.unpack_from(data, info))
+                if info_type == self.FAN_EVENT_INFO_TYPE_DFID_NAME:
+                    # The struct file_handle, without the name after it.
+                    start = info + 12
+                    handles.add(data[start:(start + 8 + handle_bytes)])
+                info += length
+            offset += event_len
+        if overflow:
+            return None
+        dirs = set()
+        for handle in handles:
+            pathname = self._get_path(handle)
+            if pathname is not None:
+                dirs.add(pathname.rstrip('/'))
+        return dirs
+
+    def _get_path(self, handle):
+        "Return the path of the directory handle, or None if it is gone."
+        fd = self._libc.open_by_handle_at(
+            self._mount_fd, handle, self.O_PATH)
+        if fd < 0:
+            return None  # ESTALE: removed since
+        try:
+            pathname = os.readlink('/proc/self/fd/{0}'.format(fd))
+        finally:
+            os.close(fd)
+        if pathname.endswith(' (deleted)'):
+            return None
+        return pathname
+
+    def close(self):
+        os.close(self._mount_fd)
+        os.close(self._fd)
+
+
+def get_watcher(pathname, events='auto'):
+    "Return a watcher for pathname: fanotify if permitted, else inotify."
+    if events in ('auto', 'fanotify'):
+        try:
+            return FanotifyWatcher(pathname)
+        except (AttributeError, OSError):
+            if events == 'fanotify':
+                raise
+    return InotifyWatcher()
+
+
+class LiveTree(object):
+    """Disk Usage Tree kept up to date from filesystem events
+
+    After one initial scan, every directory that the watcher reports is
+    listed again (not recursively) and the difference with what was
+    counted for it before is added to its node. For that, only the total
+    size of each directory's own entries and its subdirectory names are
+    remembered, not the size of every file. New directories are scanned;
+    removed directories are subtracted. The tree is pruned again after
+    each batch of events, so it doesn't grow.
+
+    The totals are exact. Like with DuMerge, a path that grows large
+    shows up with only its growth; what it had before stays in the
+    leftovers of its parent.
+    """
+    def __init__(self, pathname, watcher=None, use_apparent_size=True,
+                 detail=20):
+        # Fanotify reports real paths.
+        self._path = DuScan(path.realpath(pathname))._path  # checks it too
+        self._watcher = watcher or get_watcher(self._path)
+        self._a_or_u = use_apparent_size
+        self._detail = detail
+        # Directory path => [app, use, subdir names] of its own entries.
+        self._dirs = {}
+        self._small_size = 0
+        self.tree = None
+        self.errors = None
+
+    def scan(self):
+        "Do the initial scan, remembering the directory sizes; return it."
+        backend = Backend()
+        backend.isdir = path.isdir
+        backend.listdir = self._listdir
+        backend.lstat = self._lstat
+        scanner = DuScan(self._path, backend=backend, detail=self._detail)
+        self.tree = scanner.scan(self._a_or_u)
+        self.errors = scanner.errors
+        self._small_size = self._get_total() // self._detail
+        return self.tree
+
+    def _listdir(self, pathname):
+        self._watcher.add(pathname)  # before listing, not to miss any
+        names = listdir(pathname)
+        self._dirs[pathname.rstrip('/')] = [0, 0, set()]  # "/" is ""
+        return names
+
+    def _lstat(self, pathname):
+        st = lstat(pathname)
+        parent, name = pathname.rsplit('/', 1)
+        own = self._dirs[parent]
+        app_size, use_size = _own_size(st)
+        own[0] += app_size
+        own[1] += use_size
+        if S_ISDIR(st.st_mode):
+            own[2].add(name)
+        return st
+
+    def _get_total(self):
+        if self._a_or_u:
+            return self.tree.app_size()
+        return self.tree.use_size()
+
+    def update(self, timeout=None):
+        """Wait up to timeout seconds for events and apply them.
+
+        Return how many directories were listed again.
+        """
+        dirs = self._watcher.read(timeout)
+        if dirs is None:
+            dirs = list(self._dirs)  # events were lost, check them all
+        # Parents go first: they add new and drop removed subdirectories.
+        changed = 0
+        for pathname in sorted(dir_.rstrip('/') for dir_ in dirs):
+            if pathname in self._dirs:
+                self._rescan_dir(pathname)
+                changed += 1
+        if changed:
+            self._prune()
+        return changed
+
+    def _prune(self):
+        self._small_size = self._get_total() // self._detail
+        self.tree.prune_if_smaller_than(self._small_size, self._a_or_u)
+        self.tree.merge_upwards_if_smaller_than(
+            self._small_size, self._a_or_u)
+
+    def _get_node(self, pathname):
+        "Return the node of directory pathname, creating it if needed."
+        node = self.tree
+        if pathname != self._path:
+            for name in pathname[(len(self._path) + 1):].split('/'):
+                node = node._get_branch(name)
+        if node._nodes == []:
+            node._set_size(0, 0)  # new: a leaf until it gets branches
+        return node
+
+    def _rescan_dir(self, pathname):
+        "List pathname again and add the differences to the tree."
+        old = self._dirs.get(pathname)
+        try:
+            if old is None:
+                self._watcher.add(pathname or '/')
+            names = listdir(pathname or '/')
+        except OSError:
+            return  # removed; its parent handles that
+        own = [0, 0, set()]
+        files = {}
+        for name in names:
+            try:
+                st = lstat(pathname + '/' + name)
+            except OSError:
+                continue  # removed since
+            app_size, use_size = _own_size(st)
+            own[0] += app_size
+            own[1] += use_size
+            if S_ISDIR(st.st_mode):
+                own[2].add(name)
+            elif S_ISREG(st.st_mode):
+                files[name] = (app_size, use_size)
+        self._dirs[pathname] = own
+        old = old or [0, 0, set()]
+
+        # Files with a node of their own get their new size, and so do
+        # files that became large enough. The rest goes to the leftovers.
+        node = self._get_node(pathname)
+        app_delta, use_delta = own[0] - old[0], own[1] - old[1]
+        for branch in list(node._nodes or ()):
+            if branch._isdir is False:
+                app_size, use_size = files.pop(branch._name, (0, 0))
+                app_delta -= app_size - branch._app_size
+                use_delta -= use_size - branch._use_size
+                if app_size or use_size:
+                    branch._app_size = app_size
+                    branch._use_size = use_size
+                else:
+                    node._nodes.remove(branch)
+        for name, (app_size, use_size) in files.items():
+            if (use_size, app_size)[self._a_or_u] >= self._small_size > 0:
+                if node._nodes is None:
+                    node._make_branch()
+                node._insert_branch(DuNode.new_file(name, app_size, use_size))
+                app_delta -= app_size
+                use_delta -= use_size
+        self._add_leftovers(node, app_delta, use_delta)
+
+        for name in sorted(own[2] - old[2]):
+            self._rescan_dir(pathname + '/' + name)
+        for name in old[2] - own[2]:
+            self._remove_dir(pathname + '/' + name)
+
+    def _remove_dir(self, pathname):
+        "Subtract the removed directory pathname from the tree."
+        app_size = use_size = 0
+        prefix = pathname + '/'
+        for dir_ in list(self._dirs):
+            if dir_ == pathname or dir_.startswith(prefix):
+                own = self._dirs.pop(dir_)
+                app_size += own[0]
+                use_size += own[1]
+
+        # Drop its node; what got merged elsewhere is in the leftovers.
+        parent_path, name = pathname.rsplit('/', 1)
+        parent = self._get_node(parent_path)
+        for branch in parent._nodes or ():
+            if branch._name == name and branch._isdir:
+                parent._nodes.remove(branch)
+                app_size -= branch.app_size()
+                use_size -= branch.use_size()
+                break
+        self._add_leftovers(parent, -app_size, -use_size)
+
+    @staticmethod
+    def _add_leftovers(node, app_size, use_size):
+        if not (app_size or use_size):
+            return
+        if node._nodes is None:
+            node._add_size(app_size, use_size)
+        elif not node._nodes:
+            node._set_size(app_size, use_size)
+        elif node._nodes[-1]._isdir is None:
+            node._nodes[-1]._add_size(app_size, use_size)
+        else:
+            node.add_branches(DuNode.new_leftovers(app_size, use_size))
+
+
+class DuMerge:
+    """Disk Usage Tree merger
+
+    Combines the (pruned) trees of many scans, for instance of all hosts
+    in a cluster, into a single tree. The trees are added one by one, so
+    only the merged result needs to be kept in memory.
+    """
+    # Intermediate prunes use a smaller threshold than the final one: a
+    # path that is large in the merged result can still be small in each
+    # of the separate trees.
+    slack = 10
+
+    def __init__(self, use_apparent_size=True, by_host=False,
+                 small_size=None):
+        self._a_or_u = use_apparent_size
+        self._by_host = by_host
+        self._small_size = small_size  # None means 5% of the total
+        self._tree = DuNode.new_dir('')
+        self._app_total = self._use_total = 0
+        self.inodes = None  # whether the dumps count inodes
+
+    def add(self, tree, host=None):
+        "Merge tree into the result; with by_host it goes below /HOST."
+        if tree._name and not tree._name.startswith('/'):
+            raise ValueError(
+                'Cannot merge a tree of relative path {0!r}'.format(
+                    tree._name))
+        if self._by_host:
+            if not host:
+                raise ValueError('Merging by host requires a host name')
+            tree._name = '/' + host + tree._name
+
+        self._app_total += tree.app_size()
+        self._use_total += tree.use_size()
+
+        parent_node = self._tree
+        for name in tree._name.split('/')[1:]:
+            parent_node = parent_node._get_branch(name)
+        parent_node._merge(tree)
+
+        self._tree.prune_if_smaller_than(
+            self._get_small_size() // self.slack, self._a_or_u)
+
+    def add_file(self, fp):
+        "Merge a tree written by dump()."
+        tree, info = load(fp)
+        inodes = info.get('inodes', False)
+        if self.inodes is None:
+            self.inodes = inodes
+        elif inodes != self.inodes:
+            raise ValueError('Cannot merge inode counts with byte sizes')
+        self.add(tree, info.get('host'))
+
+    def merge(self):
+        "Return the merged tree, after pruning it at the final threshold."
+        small_size = self._get_small_size()
+        self._tree.prune_if_smaller_than(small_size, self._a_or_u)
+        self._tree.merge_upwards_if_smaller_than(small_size, self._a_or_u)
+        return self._tree
+
+    def _get_small_size(self):
+        if self._small_size is not None:
+            return self._small_size
+        return (self._use_total, self._app_total)[self._a_or_u] // 20
+
+
+def dump(tree, fp, use_apparent_size=True, host=None, aggregates=None,
+         errors=None, inodes=False):
+    "Write the tree to fp as JSON, for later loading or merging."
+    info = {
+        'dutree': 1,
+        'host': host,
+        'use_apparent_size': use_apparent_size,
+        'tree': tree.as_dict(),
+    }
+    if inodes:
+        info['inodes'] = True  # the sizes are entry counts
+    if aggregates:
+        info['aggregates'] = dict(
+            (key, counter.top()) for key, counter in aggregates.items())
+    if errors:
+        info['errors'] = errors.as_dict()
+    json.dump(info, fp)
+
+
+def load(fp):
+    "Read a tree written by dump(); returns a (tree, info) tuple."
+    info = json.load(fp)
+    if info.get('dutree') != 1:
+        raise ValueError('Not a dutree dump')
+    tree = DuNode.from_dict(info.pop('tree'))
+    return tree, info
+
+
+class TreeIndex(object):
+    """Path lookups in a scanned or load()ed tree
+
+    Built once: all nodes are kept sorted by path, along with their
+    sizes, so a lookup is a bisect instead of a walk over the tree.
+
+    A path that has no node of its own was folded into a leaf: a leaf
+    directory above it, or the "*" leftovers of a directory above it.
+    find() returns that node. Note that this works for any path below
+    the tree, whether it existed at scan time or not.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self._root = tree.path()
+        items = []
+        self._add(tree, self._root, items)
+        items.sort(key=(lambda item: item[0]))
+        self._paths = [item[0] for item in items]
+        self._nodes = [item[1] for item in items]
+        self._app_sizes = [item[2] for item in items]
+        self._use_sizes = [item[3] for item in items]
+
+    def _add(self, node, pathname, items):
+        "Add node and its branches to items; return its sizes."
+        if node._nodes is None:
+            app_size, use_size = node._app_size, node._use_size
+        else:
+            app_size = use_size = 0
+            for branch in node._nodes:
+                branch_sizes = self._add(
+                    branch, pathname + '/' + branch._name, items)
+                app_size += branch_sizes[0]
+                use_size += branch_sizes[1]
+        items.append((pathname, node, app_size, use_size))
+        return app_size, use_size
+
+    @staticmethod
+    def _normpath(pathname):
+        "Return the path like DuNode.path(): no trailing slash."
+        return pathname.rstrip('/')
+
+    def _index(self, pathname):
+        "Return the index of the node at pathname, or None."
+        index = bisect_left(self._paths, pathname)
+        if index < len(self._paths) and self._paths[index] == pathname:
+            return index
+        return None
+
+    def get(self, pathname):
+        "Return the node at exactly pathname, or None."
+        index = self._index(self._normpath(pathname))
+        return None if index is None else self._nodes[index]
+
+    def size(self, pathname, use_apparent_size=True):
+        "Return the size of the node at exactly pathname, or None."
+        index = self._index(self._normpath(pathname))
+        if index is None:
+            return None
+        return (self._use_sizes, self._app_sizes)[use_apparent_size][index]
+
+    def find(self, pathname):
+        """Return the node holding pathname, or None if outside the tree.
+
+        That is the node at pathname itself, if there is one. Otherwise
+        it is the leaf its size was counted in.
+        """
+        pathname = self._normpath(pathname)
+        index = self._index(pathname)
+        if index is not None:
+            return self._nodes[index]
+        if not pathname.startswith(self._root + '/'):
+            return None
+
+        # Find the deepest node above it; the root is one.
+        while index is None:
+            pathname = pathname.rsplit('/', 1)[0]
+            index = self._index(pathname)
+        node = self._nodes[index]
+        if node._nodes is None:
+            return node if node._isdir else None
+        # The leftovers of the directory. Or those of a directory above
+        # it, if merge_upwards_if_smaller_than() moved them there.
+        while node is not None:
+            if node._nodes and node._nodes[-1]._isdir is None:
+                return node._nodes[-1]
+            node = node._parent
+        return None
+
+    def get_leaves(self, pathname):
+        """Return the leaves at or below pathname.
+
+        They are in DuNode.get_leaves() order: the leftovers last.
+        """
+        # Every node has its parents as nodes, so nothing below a path
+        # without a node has one either.
+        index = self._index(self._normpath(pathname))
+        if index is None:
+            return []
+        return self._nodes[index].get_leaves()
+
 
 def human(value):
     "If val>=1000 return val/1024+KiB, etc."
@@ -467,36 +3219,600 @@ def human(value):
     return '{}   B'.format(value)
 
 
-def main():
-    pathname = None
-    if len(sys.argv) == 2:
-        def getsize(node):
-            return node.app_size()
+def parse_size(value):
+    "Parse 300, 512K, 4G, etc. into a number of bytes."
+    suffixes = 'KMGTP'
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in suffixes:
+        return int(float(value[0:-1]) * (
+            1024 ** (suffixes.index(value[-1]) + 1)))
+    return int(value)
 
-        pathname = sys.argv[1]
-        use_apparent_size = True
 
-    elif len(sys.argv) == 3:
-        def getsize(node):
-            return node.use_size()
+class TreeBrowser(object):
+    """Drill down into a detailed scan, without scanning again
 
-        if sys.argv[1] == '--count-blocks':
-            pathname = sys.argv[2]
-        elif sys.argv[2] == '--count-blocks':
-            pathname = sys.argv[1]
-        use_apparent_size = False
+    The focused node is shown the way dutree would show a scan of just
+    that path: only entries of at least 1/20th of its size. Entering a
+    directory focuses on it. Entering a leftover node focuses on the
+    entries of its directory that weren't shown separately.
 
-    if pathname is None:
-        sys.stderr.write('Usage: dutree [--count-blocks] PATH\n')
-        sys.exit(1)
+    The view skips merge_upwards_if_smaller_than(), so every leftover
+    node stands for the remainder of exactly one directory. Scan the
+    tree with a higher detail and without merge_upwards for the same
+    reason.
+    """
+    def __init__(self, tree, use_apparent_size=True):
+        self._a_or_u = use_apparent_size
+        self._stack = []  # (node, excluded sort keys) of the focused views
+        self.focus(tree)
+
+    def focus(self, node, exclude=()):
+        self._stack.append((node, frozenset(exclude)))
+        self._set_view()
+
+    def back(self):
+        "Return to the previous focus; returns False if there is none."
+        if len(self._stack) == 1:
+            return False
+        self._stack.pop()
+        self._set_view()
+        return True
+
+    def _set_view(self):
+        node, exclude = self._stack[-1]
+        if node._nodes is None:
+            view = DuNode.from_dict(node.as_dict())
+        else:
+            view = DuNode.from_dict({
+                'name': node._name, 'type': 'dir', 'nodes': [
+                    i.as_dict() for i in node._nodes
+                    if i._sort_key() not in exclude]})
+        view._name = node.path()
+        view.prune_if_smaller_than(self.size(view) // 20, self._a_or_u)
+        self._view = view
+        self._entries = view.get_leaves()
+
+    def size(self, node):
+        return node.app_size() if self._a_or_u else node.use_size()
+
+    def title(self):
+        node, exclude = self._stack[-1]
+        return node.path() + ('/*' if exclude else '/')
+
+    def total(self):
+        return self.size(self._view)
+
+    def entries(self):
+        "Return the leaves of the focused view."
+        return self._entries
+
+    def enter(self, index):
+        "Focus on entry index; returns False if there is nothing inside."
+        leaf = self._entries[index]
+        if leaf is self._view:
+            return False  # everything is in one node already
+        if leaf._isdir is None:
+            # Leftovers: the rest of the directory it is in.
+            view_dir, detail_dir = leaf._parent, self._find(leaf._parent)
+            if view_dir is None or detail_dir._nodes is None:
+                return False
+            shown = set(
+                (i._name, i._isdir) for i in view_dir._nodes
+                if i._isdir is not None)
+            exclude = [
+                i._sort_key() for i in detail_dir._nodes
+                if (i._name, i._isdir) in shown]
+            rest = [
+                i for i in detail_dir._nodes
+                if i._sort_key() not in exclude]
+            if len(rest) == 1 and rest[0]._isdir is None:
+                return False  # scanned without more detail
+            self.focus(detail_dir, exclude)
+            return True
 
-    run(pathname, use_apparent_size, getsize)
+        node = self._find(leaf)
+        if node._nodes is None:
+            return False
+        self.focus(node)
+        return True
+
+    def _find(self, view_node):
+        "Return the scanned node for the view node (not a leftover)."
+        names = []
+        while view_node._parent is not None:
+            names.append((view_node._name, view_node._isdir))
+            view_node = view_node._parent
+        node = self._stack[-1][0]
+        for name, isdir in reversed(names):
+            for node in node._nodes:
+                if (node._name, node._isdir) == (name, isdir):
+                    break
+        return node
+
+    def run(self, stdscr):
+        "Curses main loop; pass this to curses.wrapper()."
+        import curses
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        selected = [0]  # selected entry for each focus
+        while True:
+            entries, total = self.entries(), self.total()
+            height, width = stdscr.getmaxyx()
+            rows = max(height - 2, 1)
+            cur = selected[-1] = min(selected[-1], max(len(entries) - 1, 0))
+            top = max(cur - rows + 1, 0)
+
+            stdscr.erase()
+            stdscr.addnstr(0, 0, ' {0:>7s}  {1}'.format(
+                human(total), self.title()), width - 1, curses.A_BOLD)
+            for y, leaf in enumerate(entries[top:(top + rows)]):
+                size = self.size(leaf)
+                bar = '#' * (10 * size // total) if total else ''
+                stdscr.addnstr(
+                    y + 1, 0, ' {0:>7s} [{1:<10s}] {2}'.format(
+                        human(size), bar, leaf.name()), width - 1,
+                    curses.A_REVERSE if top + y == cur else curses.A_NORMAL)
+            stdscr.addnstr(
+                height - 1, 0, ' enter: expand, backspace: back, q: quit',
+                width - 1)
+            stdscr.refresh()
+
+            key = stdscr.getch()
+            if key in (ord('q'), 27):
+                break
+            elif key in (curses.KEY_UP, ord('k')):
+                selected[-1] = max(cur - 1, 0)
+            elif key in (curses.KEY_DOWN, ord('j')):
+                selected[-1] = cur + 1
+            elif key == curses.KEY_PPAGE:
+                selected[-1] = max(cur - rows, 0)
+            elif key == curses.KEY_NPAGE:
+                selected[-1] = cur + rows
+            elif key in (curses.KEY_RIGHT, curses.KEY_ENTER, 10, 13,
+                         ord('l')):
+                if entries and self.enter(cur):
+                    selected.append(0)
+                else:
+                    curses.beep()
+            elif key in (curses.KEY_LEFT, curses.KEY_BACKSPACE, 127, 8,
+                         ord('h')):
+                if self.back():
+                    selected.pop()
+                else:
+                    curses.beep()
 
 
-def run(pathname, use_apparent_size, getsize):
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        return main_merge(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        return main_watch(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        return main_worker(sys.argv[2:])
+
+    parser = ArgumentParser(
+        prog='dutree',
+        description='Disk usage summary, showing large dirs/files.',
+        epilog=(
+            'Use "dutree merge --help" for combining JSON results, '
+            '"dutree watch --help" for keeping a tree up to date, and '
+            '"dutree worker --help" for helping a --shard-queue scan.'))
+    parser.add_argument(
+        '--count-blocks', action='store_true',
+        help='use the used block size instead of the apparent size')
+    parser.add_argument(
+        '--inodes', action='store_true',
+        help=(
+            'count directory entries instead of bytes; this needs no '
+            'lstat calls, so it is a lot faster'))
+    parser.add_argument(
+        '--json', action='store_true',
+        help='write the tree as JSON, for use with "dutree merge"')
+    parser.add_argument(
+        '--engine', choices=('lstat', 'statx'), default='lstat',
+        help=(
+            'how to fetch file metadata; statx only asks for the fields '
+            'dutree needs (Linux only, falls back to lstat)'))
+    parser.add_argument(
+        '--dont-sync', action='store_true',
+        help=(
+            'with --engine=statx, allow network filesystems to answer '
+            'from cached attributes (AT_STATX_DONT_SYNC)'))
+    parser.add_argument(
+        '--inventory', metavar='FILE',
+        help=(
+            "read the tree from the output of find PATH -printf "
+            "'%%s %%b %%y %%p\\n' in FILE (- for stdin), instead of "
+            "scanning the filesystem"))
+    parser.add_argument(
+        '--jobs-per-device', metavar='N', type=int,
+        help=(
+            'scan the top level directories and mount points concurrently, '
+            'with up to N jobs per device (1 for spinning disks)'))
+    parser.add_argument(
+        '--device-jobs', metavar='PATH=N', action='append', default=[],
+        help=(
+            'with --jobs-per-device, use N jobs for the device holding PATH '
+            '(can be repeated)'))
+    parser.add_argument(
+        '--shard-queue', metavar='DIR',
+        help=(
+            'hand the top level directories and mount points out to '
+            '"dutree worker DIR" processes, on any host that can reach DIR '
+            'and PATH'))
+    parser.add_argument(
+        '--local-workers', metavar='N', type=int, default=0,
+        help='with --shard-queue, also start N workers on this host')
+    parser.add_argument(
+        '--split-depth', metavar='N', type=int, default=1,
+        help=(
+            'with --jobs-per-device or --shard-queue, split the work at '
+            'the directories N levels deep (default: 1)'))
+    parser.add_argument(
+        '--timeout', metavar='SECS', type=float,
+        help=(
+            'give up on filesystem calls that take longer than SECS, like '
+            'those on a dead NFS server, and skip the rest of that mount'))
+    parser.add_argument(
+        '--max-iops', metavar='N', type=float,
+        help='do at most N listdir/lstat calls per second')
+    parser.add_argument(
+        '--max-dirs-per-sec', metavar='N', type=float,
+        help='list at most N directories per second')
+    parser.add_argument(
+        '--idle', action='store_true',
+        help=(
+            'run with the lowest CPU priority and the idle I/O class, so '
+            'production workloads are not hurt'))
+    parser.add_argument(
+        '--inode-order', action='store_true',
+        help=(
+            'stat directory entries in inode number order; this saves '
+            'seeks on spinning disks'))
+    parser.add_argument(
+        '--histogram', action='store_true',
+        help='also show the distribution of file sizes per path')
+    parser.add_argument(
+        '--ages', action='store_true',
+        help='also show how much data per path was modified when')
+    parser.add_argument(
+        '--atime', action='store_true',
+        help='use the access time instead of the modification time')
+    parser.add_argument(
+        '--stale', metavar='DAYS', type=float,
+        help='only count data that was not modified for DAYS days')
+    parser.add_argument(
+        '--by', metavar='KEYS', type=(lambda x: x.split(',')), default=(),
+        help=(
+            'also show the largest users of space by uid, gid and/or ext '
+            '(comma separated)'))
+    parser.add_argument(
+        '--top', metavar='N', type=int, default=10,
+        help='how many keys to show for --by (default: 10)')
+    parser.add_argument(
+        '--max-memory', metavar='SIZE', type=parse_size,
+        help=(
+            'prune early whenever the retained nodes would take more than '
+            'about SIZE of memory; this makes the result less precise'))
+    parser.add_argument(
+        '--browse', action='store_true',
+        help=(
+            'browse a detailed scan interactively; use --max-memory to '
+            'limit the detail of large trees'))
+    parser.add_argument(
+        '--expect', metavar='SOURCE',
+        help=(
+            'start out ignoring small files and dirs, based on the expected '
+            'total: "statvfs" (for a mount point), the JSON output of a '
+            'previous scan, or a SIZE; this saves memory and time'))
+    parser.add_argument(
+        '--checkpoint', metavar='FILE',
+        help=(
+            'periodically save the scan state to FILE, so an interrupted '
+            'scan can be continued with --resume'))
+    parser.add_argument(
+        '--checkpoint-interval', metavar='SECS', type=float, default=60,
+        help='how often to save the --checkpoint (default: 60)')
+    parser.add_argument(
+        '--resume', metavar='FILE',
+        help=(
+            'continue the scan saved in checkpoint FILE; PATH and '
+            '--count-blocks are taken from FILE'))
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='warn about every unreadable file, instead of a summary')
+    parser.add_argument('path', metavar='PATH', nargs='?')
+    args = parser.parse_args()
+
+    resume = None
+    if args.resume:
+        resume = DuScan.load_checkpoint(args.resume)
+        args.path = resume['path']
+        args.count_blocks = not resume['use_apparent_size']
+        args.checkpoint = args.checkpoint or args.resume
+    elif not args.path:
+        parser.error('the following arguments are required: PATH')
+    if args.checkpoint and (args.jobs_per_device or args.shard_queue):
+        parser.error(
+            '--checkpoint cannot be used with --jobs-per-device or '
+            '--shard-queue')
+    if args.inodes and (
+            args.engine != 'lstat' or args.inode_order or args.histogram or
+            args.ages or args.stale or args.by or args.browse):
+        parser.error(
+            '--inodes cannot be used with --engine, --inode-order, '
+            '--histogram, --ages, --stale, --by or --browse')
+    for key in args.by:
+        if key not in ('uid', 'gid', 'ext'):
+            parser.error(
+                '--by: unknown key {0!r}, use uid, gid and/or ext'.format(
+                    key))
+    if args.inventory and (
+            args.jobs_per_device or args.shard_queue or args.checkpoint or
+            args.engine != 'lstat'):
+        parser.error(
+            '--inventory cannot be used with --jobs-per-device, '
+            '--shard-queue, --checkpoint or --engine')
+    if args.timeout and args.shard_queue:
+        parser.error(
+            '--timeout cannot be used with --shard-queue, the workers '
+            'scan the filesystem')
+
+    max_nodes = None
+    if args.max_memory:
+        max_nodes = max(args.max_memory // _NodeStore.ROW_BYTES, 100)
+    backend = None
+    if args.inventory == '-':
+        backend = InventoryBackend(sys.stdin)
+    elif args.inventory:
+        backend = InventoryBackend(open(args.inventory))
+    watchdog = None
+    if args.timeout:
+        if args.engine == 'statx':
+            parser.error('--engine=statx cannot be used with --timeout')
+        backend = watchdog = WatchdogBackend(backend, timeout=args.timeout)
+    if args.idle and not set_low_priority():
+        warnings.warn('Could not set the idle I/O priority', OsWarning)
+    kwargs = dict(
+        max_iops=args.max_iops, max_dirs_per_sec=args.max_dirs_per_sec,
+        engine=args.engine, dont_sync=args.dont_sync,
+        inode_order=args.inode_order, backend=backend,
+        max_nodes=max_nodes, histogram=args.histogram, aggregate=args.by,
+        ages=args.ages, use_atime=args.atime,
+        min_age=(args.stale and args.stale * 86400), verbose=args.verbose,
+        detail=(1000 if args.browse else 20), inodes=args.inodes)
+    if args.expect:
+        kwargs['expected_size'] = get_expected_size(
+            args.expect, args.path, not args.count_blocks, args.inodes)
+    if args.checkpoint:
+        kwargs.update(
+            checkpoint=args.checkpoint,
+            checkpoint_interval=args.checkpoint_interval)
+    if args.shard_queue:
+        scanner = ShardedDuScan(
+            args.path, args.shard_queue, split_depth=args.split_depth,
+            local_workers=args.local_workers, **kwargs)
+    elif args.jobs_per_device:
+        device_jobs = {}
+        for value in args.device_jobs:
+            path_, jobs = value.rsplit('=', 1)
+            device_jobs[os.stat(path_).st_dev] = int(jobs)
+        scanner = ParallelDuScan(
+            args.path, scheduler=DeviceScheduler(
+                default_jobs=args.jobs_per_device, jobs=device_jobs),
+            split_depth=args.split_depth, **kwargs)
+    else:
+        scanner = DuScan(args.path, **kwargs)
+    if resume:
+        try:
+            scanner._check_checkpoint(resume, not args.count_blocks)
+        except ValueError as e:
+            parser.error('--resume: {0}'.format(e))
+    if args.browse:
+        browse(scanner, not args.count_blocks, resume)
+    else:
+        run(scanner, not args.count_blocks, args.json, args.histogram,
+            args.top, args.ages, resume, args.inodes)
+    if watchdog is not None and watchdog.stalls:
+        print_stalls(watchdog)
+
+
+def main_merge(argv):
+    parser = ArgumentParser(
+        prog='dutree merge',
+        description=(
+            'Merge the JSON output of many "dutree --json" runs into a '
+            'single summary.'))
+    parser.add_argument(
+        '--by-host', action='store_true',
+        help='place each tree below /HOST instead of merging by path')
+    parser.add_argument(
+        '--count-blocks', action='store_true',
+        help='use the used block size instead of the apparent size')
+    parser.add_argument(
+        '--threshold', metavar='SIZE', type=parse_size,
+        help='show paths of at least SIZE (default: 5%% of the total)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='write the merged tree as JSON')
+    parser.add_argument(
+        'files', metavar='FILE', nargs='+',
+        help='JSON file; use - to read file names from stdin')
+    args = parser.parse_args(argv)
+
+    use_apparent_size = not args.count_blocks
+    merger = DuMerge(
+        use_apparent_size=use_apparent_size, by_host=args.by_host,
+        small_size=args.threshold)
+    for filename in _iter_filenames(args.files):
+        with open(filename) as fp:
+            merger.add_file(fp)
+    tree = merger.merge()
+
+    if args.json:
+        dump(tree, sys.stdout, use_apparent_size, inodes=merger.inodes)
+    else:
+        print_tree(tree, use_apparent_size, merger.inodes)
+
+
+def _iter_filenames(filenames):
+    for filename in filenames:
+        if filename == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.rstrip('\r\n')
+        else:
+            yield filename
+
+
+def main_worker(argv):
+    parser = ArgumentParser(
+        prog='dutree worker',
+        description=(
+            'Scan shards of a "dutree --shard-queue DIR" scan until all '
+            'are done.'))
+    parser.add_argument(
+        '--wait', metavar='SECS', type=float, default=60,
+        help='how long to wait for the queue to show up (default: 60)')
+    parser.add_argument(
+        '--idle', action='store_true',
+        help='run with the lowest CPU and I/O priority')
+    parser.add_argument('queue', metavar='DIR')
+    args = parser.parse_args(argv)
+
+    if args.idle and not set_low_priority():
+        warnings.warn('Could not set the idle I/O priority', OsWarning)
+    done = ShardWorker(args.queue, wait=args.wait).run()
+    sys.stderr.write('dutree: scanned {0} shards\n'.format(done))
+
+
+def main_watch(argv):
+    parser = ArgumentParser(
+        prog='dutree watch',
+        description=(
+            'Scan once, then keep the summary up to date from filesystem '
+            'events (fanotify where permitted, inotify otherwise).'))
+    parser.add_argument(
+        '--count-blocks', action='store_true',
+        help='use the used block size instead of the apparent size')
+    parser.add_argument(
+        '--interval', metavar='SECS', type=float, default=10,
+        help='show the summary at most every SECS seconds (default: 10)')
+    parser.add_argument(
+        '--events', choices=('auto', 'fanotify', 'inotify'), default='auto',
+        help='which event interface to use (default: auto)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='write each summary as a line of JSON')
+    parser.add_argument('path', metavar='PATH')
+    args = parser.parse_args(argv)
+
+    use_apparent_size = not args.count_blocks
+    live = LiveTree(
+        args.path, watcher=get_watcher(args.path, args.events),
+        use_apparent_size=use_apparent_size)
+    live.scan()
+    if live.errors:
+        print_errors(live.errors)
+    try:
+        while True:
+            if args.json:
+                dump(live.tree, sys.stdout, use_apparent_size,
+                     socket.gethostname())
+                sys.stdout.write('\n')
+            else:
+                print_tree(live.tree, use_apparent_size)
+                sys.stdout.write('\n')
+            sys.stdout.flush()
+            # Wait for changes, then collect them for the interval.
+            while not live.update():
+                pass
+            deadline = _monotonic() + args.interval
+            while _monotonic() < deadline:
+                live.update(max(deadline - _monotonic(), 0))
+    except KeyboardInterrupt:
+        pass
+
+
+def get_expected_size(source, pathname, use_apparent_size, inodes=False):
+    "Return the expected size of the tree at pathname for --expect."
+    if source == 'statvfs':
+        size = get_statvfs_used(pathname, inodes)
+        if size is None:
+            warnings.warn(
+                '{0} is not a mount point, ignoring --expect'.format(
+                    pathname), OsWarning)
+        return size
+    if not path.isfile(source):
+        return parse_size(source)
+    with open(source) as fp:
+        tree, info = load(fp)
+    if path.abspath(tree.name()) != path.abspath(pathname):
+        warnings.warn(
+            '{0} is a scan of {1}, ignoring --expect'.format(
+                source, tree.name()), OsWarning)
+        return None
+    if info.get('inodes', False) != inodes:
+        warnings.warn(
+            '{0} does not count {1}, ignoring --expect'.format(
+                source, ('bytes', 'inodes')[inodes]), OsWarning)
+        return None
+    return tree.app_size() if use_apparent_size else tree.use_size()
+
+
+def run(scanner, use_apparent_size, as_json=False, histogram=False, top=10,
+        ages=False, resume=None, inodes=False):
+    tree = scanner.scan(use_apparent_size=use_apparent_size, resume=resume)
+    if as_json:
+        if tree._name and not tree._name.startswith('/'):
+            tree._name = path.abspath(tree._name)  # for merging by path
+        dump(
+            tree, sys.stdout, use_apparent_size, socket.gethostname(),
+            aggregates=scanner.aggregates, errors=scanner.errors,
+            inodes=inodes)
+    else:
+        print_tree(tree, use_apparent_size, inodes)
+        if histogram:
+            print_histograms(tree)
+        if ages:
+            print_ages(tree)
+        for key in sorted(scanner.aggregates):
+            print_aggregate(key, scanner.aggregates[key], top)
+    if scanner.errors:
+        print_errors(scanner.errors)
+
+
+def browse(scanner, use_apparent_size, resume=None):
+    import curses
+    tree = scanner.scan(
+        use_apparent_size=use_apparent_size, merge_upwards=False,
+        resume=resume)
+    curses.wrapper(TreeBrowser(tree, use_apparent_size).run)
+    if scanner.errors:
+        print_errors(scanner.errors)
+
+
+def print_tree(tree, use_apparent_size, inodes=False):
+    if inodes:
+        # Both sizes are the count.
+        for leaf in tree.get_leaves():
+            sys.stdout.write(' {0:>7d}  {1}\n'.format(
+                leaf.app_size(), leaf.name()))
+        sys.stdout.write('   -----\n')
+        sys.stdout.write(' {0:>7d}  TOTAL inodes\n'.format(tree.app_size()))
+        return
+
     verbose = True and not use_apparent_size
-    scanner = DuScan(pathname)
-    tree = scanner.scan(use_apparent_size=use_apparent_size)
+    if use_apparent_size:
+        def getsize(node):
+            return node.app_size()
+    else:
+        def getsize(node):
+            return node.use_size()
+
     for leaf in tree.get_leaves():
         sys.stdout.write(' {0:>7s}  {1}{2}\n'.format(
             human(getsize(leaf)), leaf.name(),
@@ -508,6 +3824,79 @@ def run(pathname, use_apparent_size, getsize):
         ', app={}'.format(human(tree.app_size())) if verbose else ''))
 
 
+def print_histograms(tree):
+    "Print the file size distribution of every leaf and of the total."
+    for node in tree.get_leaves() + [tree]:
+        hist = node.histogram()
+        if hist is None:
+            continue
+        sys.stdout.write('\n{0}\n'.format(
+            'TOTAL' if node is tree else node.name()))
+        for min_size, max_size, count, size in hist.buckets():
+            sys.stdout.write(
+                ' {0:>7s} - {1:>7s}  {2:10d} files  {3:>7s}\n'.format(
+                    human(min_size), human(max_size), count, human(size)))
+
+
+def print_ages(tree):
+    "Print the bytes per age bucket of every leaf and of the total."
+    sys.stdout.write('\n{0}\n'.format(''.join(
+        ' {0:>7s}'.format(label) for label in AgeBuckets.LABELS)))
+    for node in tree.get_leaves() + [tree]:
+        ages = node.ages()
+        if ages is not None:
+            sys.stdout.write('{0}  {1}\n'.format(
+                ''.join(' {0:>7s}'.format(human(i)) for i in ages.sizes),
+                'TOTAL' if node is tree else node.name()))
+
+
+def print_aggregate(key, counter, top):
+    "Print the largest keys of a uid/gid/ext TopCounter."
+    def get_name(key_id):
+        try:
+            if key == 'uid':
+                return pwd.getpwuid(key_id).pw_name
+            return grp.getgrgid(key_id).gr_name
+        except KeyError:
+            return str(key_id)
+
+    sys.stdout.write('\nBy {0}:\n'.format(key))
+    for key_id, size, files, error in counter.top(top):
+        if key == 'ext':
+            name = '.' + key_id if key_id else '(none)'
+        else:
+            name = '{0} ({1})'.format(key_id, get_name(key_id))
+        sys.stdout.write(' {0:>7s}  {1}{2}\n'.format(
+            human(size), name,
+            ' (+/- {0})'.format(human(error)) if error else ''))
+
+
+def print_errors(errors):
+    "Summarize the scan errors on stderr."
+    sys.stderr.write('dutree: {0} errors while scanning\n'.format(
+        errors.count))
+    for errno_, count, files, error in errors.by_errno.top(5):
+        sys.stderr.write('  {0:>9d}  [Errno {1}] {2}\n'.format(
+            count, errno_, os.strerror(errno_) if errno_ else '?'))
+    for dir_, count, files, error in errors.by_dir.top(5):
+        sys.stderr.write('  {0:>9d}  {1}\n'.format(count, dir_ or '/'))
+    for filename, errno_, strerror in errors.examples:
+        sys.stderr.write('  [Errno {0}] {1}: {2!r}\n'.format(
+            errno_, strerror, filename))
+
+
+def print_stalls(watchdog):
+    "Show on stderr which mount points stalled, and how often."
+    sys.stderr.write(
+        'dutree: calls timed out, these subtrees are incomplete:\n')
+    for mount_point, count in sorted(
+            watchdog.stalls.items(), key=(lambda x: (-x[1], x[0]))):
+        sys.stderr.write('  {0:>9d}  {1} (stalled mount point)\n'.format(
+            count, mount_point))
+    for pathname in watchdog.timed_out:
+        sys.stderr.write('  timed out: {0}\n'.format(pathname))
+
+
 def formatwarning(message, category, filename, lineno, line=None):
     """
     Override default Warning layout, from:
@@ -0,0 +1,369 @@
+# dutree -- a quick and memory efficient disk usage scanner
+# Copyright (C) 2018,2019  Walter Doekes, OSSO B.V.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# The equivalence checks herein scan many generated filesystems with
+# every scan engine/option set and with a plain reference scanner. All
+# of them must produce the same leaves, except for those that prune
+# differently on purpose (max_nodes, parallel), which must still get the
+# totals right. Run them from this directory:
+#
+#     python fuzz_dutree.py [--trees N] [--jobs N] [--seed N]
+#
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool, cpu_count
+from stat import S_ISDIR, S_ISREG
+
+from bogofs import GeneratedFilesystem
+
+import dutree
+
+
+class NarrowFilesystem(GeneratedFilesystem):
+    "Deep trees with few dirs per level."
+    def how_many_dirs(self):
+        return self.randint(0, 3)
+
+
+class FlatFilesystem(GeneratedFilesystem):
+    "A single directory with many files."
+    def how_many_dirs(self):
+        return 0
+
+    def how_many_files(self):
+        return self.randint(0, 5000)
+
+
+class LargeFilesFilesystem(GeneratedFilesystem):
+    "Few files, most of them large."
+    def how_many_files(self):
+        return self.randint(0, 4)
+
+    def how_large_file(self):
+        if self.randint(0, 3):
+            return self.randint(1, 2 ** 31)
+        return self.randint(1, 2 ** 12)
+
+
+class SparseFilesystem(GeneratedFilesystem):
+    "Mostly empty dirs."
+    def how_many_files(self):
+        return self.randint(0, 8) // 7
+
+
+# (filesystem class, maxdepth) pairs to pick from.
+SHAPES = (
+    (GeneratedFilesystem, 1),
+    (GeneratedFilesystem, 2),
+    (GeneratedFilesystem, 3),
+    (NarrowFilesystem, 5),
+    (FlatFilesystem, 0),
+    (LargeFilesFilesystem, 3),
+    (SparseFilesystem, 3),
+)
+
+
+def find_printf(fs, path, lines):
+    "Append find PATH -printf '%s %b %y %p\\n' output to lines."
+    st = fs.stat(path)
+    lines.append(u'{0} {1} d {2}\n'.format(st.st_size, st.st_blocks, path))
+    for name in fs.listdir(path):
+        child = path.rstrip('/') + '/' + name
+        st = fs.stat(child)
+        if fs.isdir(child):
+            find_printf(fs, child, lines)
+        else:
+            lines.append(u'{0} {1} f {2}\n'.format(
+                st.st_size, st.st_blocks, child))
+
+
+def inventory_backend(fs):
+    lines = []
+    find_printf(fs, '/', lines)
+    return dutree.InventoryBackend(lines)
+
+
+def listdir_backend(fs):
+    "A backend without scandir, like the plain os.listdir() fallback."
+    backend = dutree.Backend()
+    backend.isdir = fs.isdir
+    backend.listdir = fs.listdir
+    backend.lstat = fs.stat
+    return backend
+
+
+def watchdog_backend(fs):
+    return dutree.WatchdogBackend(fs, mount_points=[])
+
+
+class Interrupted(Exception):
+    pass
+
+
+def duscan(**kwargs):
+    """Return a scan function for DuScan with kwargs.
+
+    A callable backend is called with the filesystem.
+    """
+    def scan(fs, use_apparent_size):
+        kw = dict(kwargs)
+        kw['backend'] = kw.get('backend', lambda fs: fs)(fs)
+        return dutree.DuScan('/', **kw).scan(use_apparent_size)
+    return scan
+
+
+def resumed_scan(fs, use_apparent_size):
+    "Interrupt a checkpointing scan a quarter of the way and resume it."
+    calls = []
+    quarter = (len(list(walk(fs, ''))) + 3) // 4
+
+    def lstat(path):
+        calls.append(path)
+        if len(calls) == quarter:
+            raise Interrupted()
+        return fs.stat(path)
+
+    backend = listdir_backend(fs)
+    backend.lstat = lstat
+    # A checkpoint is written (and synced) for every directory: keep
+    # them in memory if we can.
+    tmpdir = tempfile.mkdtemp(
+        prefix='dutree-fuzz-',
+        dir=('/dev/shm' if os.path.isdir('/dev/shm') else None))
+    try:
+        checkpoint = os.path.join(tmpdir, 'checkpoint.json')
+        try:
+            return dutree.DuScan(
+                '/', backend=backend, checkpoint=checkpoint,
+                checkpoint_interval=0).scan(use_apparent_size)
+        except Interrupted:
+            pass
+        state = dutree.DuScan.load_checkpoint(checkpoint)
+        return dutree.DuScan('/', backend=fs).scan(
+            use_apparent_size, resume=state)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def parallel_scan(fs, use_apparent_size):
+    return dutree.ParallelDuScan(
+        '/', backend=fs, mount_points=[]).scan(use_apparent_size)
+
+
+# Scan functions of every engine/option set that must yield exactly the
+# same leaves as the reference.
+ENGINES = (
+    ('lstat', duscan()),
+    ('inode_order', duscan(inode_order=True)),
+    ('inventory', duscan(backend=inventory_backend)),
+    ('listdir', duscan(backend=listdir_backend)),
+    ('watchdog', duscan(backend=watchdog_backend)),
+    ('stats', duscan(
+        histogram=True, ages=True, aggregate=('uid', 'gid', 'ext'))),
+    ('resume', resumed_scan),
+)
+
+# Scan functions that may keep less (max_nodes) or a bit more (parallel)
+# detail than the reference, with whether the sizes of the leaves they
+# keep must be exact. Their totals must be exact regardless. The unit
+# scans of a parallel scan may have moved small leftovers up and out of
+# their unit, so its leaves are only checked not to be too large.
+COARSE_ENGINES = (
+    ('max_nodes', duscan(max_nodes=12), True),
+    ('parallel', parallel_scan, False),
+)
+
+
+def walk(fs, path):
+    "Yield (path, is_dir, stat) for everything below path."
+    for name in fs.listdir(path or '/'):
+        child = path + '/' + name
+        st = fs.stat(child)
+        is_dir = S_ISDIR(st.st_mode)
+        yield child, is_dir, st
+        if is_dir:
+            for item in walk(fs, child):
+                yield item
+
+
+def reference_scan(fs, path, use_apparent_size=True):
+    """Scan the generated filesystem the straightforward way.
+
+    No node store, no stack of frames and no early pruning: this keeps
+    a plain DuNode tree and applies the dutree rules as written.
+    """
+    scanner = _ReferenceScan(fs, use_apparent_size)
+    tree = dutree.DuNode.new_dir(path)
+    fraction = scanner.scan_dir(path, tree)[2]
+    tree.prune_if_smaller_than(fraction, use_apparent_size)
+    tree.merge_upwards_if_smaller_than(fraction, use_apparent_size)
+    return tree
+
+
+class _ReferenceScan(object):
+    def __init__(self, fs, use_apparent_size):
+        self.fs = fs
+        self.index = (1, 0)[use_apparent_size]  # into [app, use] sizes
+        self.subtotal = 0
+
+    def scan_dir(self, path, node):
+        "Fill node; return (leftover sizes, keep_node, new fraction)."
+        fraction = self.subtotal // 20
+        children = []
+        mixed = [0, 0]  # apparent and used size of the rest of the dir
+        for name in self.fs.listdir(path or '/'):
+            st = self.fs.stat(path + '/' + name)
+            own = [st.st_size, st.st_blocks << 9]
+            if S_ISREG(st.st_mode):
+                if not st.st_blocks:
+                    own = [0, 0]
+                if own[self.index] >= fraction:
+                    children.append(dutree.DuNode.new_file(name, *own))
+                    self.subtotal += own[self.index]
+                    own = [0, 0]
+            elif S_ISDIR(st.st_mode):
+                child = dutree.DuNode.new_dir(name)
+                leftovers, keep_node, fraction = self.scan_dir(
+                    path + '/' + name, child)
+                if keep_node:
+                    children.append(child)
+                mixed[0] += leftovers[0]
+                mixed[1] += leftovers[1]
+            mixed[0] += own[0]
+            mixed[1] += own[1]
+            self.subtotal += own[self.index]
+            fraction = self.subtotal // 20
+
+        if not children and mixed[self.index] < fraction:
+            return mixed, False, fraction
+        if children:
+            node.add_branches(*children)
+            node.add_branches(dutree.DuNode.new_leftovers(*mixed))
+        else:
+            node._set_size(*mixed)
+        return [0, 0], True, fraction
+
+
+def as_list(tree):
+    return [
+        (leaf.name(), leaf.app_size(), leaf.use_size())
+        for leaf in tree.get_leaves()]
+
+
+def content_sizes(fs):
+    "Return {leaf name: (app_size, use_size)} of all files and dirs."
+    sizes = {'/': [0, 0]}
+    for path, is_dir, st in walk(fs, ''):
+        own = [st.st_size, st.st_blocks << 9]
+        if not st.st_blocks and not is_dir:
+            own = [0, 0]
+        sizes[path + ('', '/')[is_dir]] = [0, 0]
+        # The dir itself counts towards its parent.
+        parent = path
+        while parent:
+            parent = parent.rsplit('/', 1)[0]
+            sizes[parent + '/'][0] += own[0]
+            sizes[parent + '/'][1] += own[1]
+        if not is_dir:
+            sizes[path] = own
+    return dict((name, tuple(size)) for name, size in sizes.items())
+
+
+def check_coarse(result, expected, sizes, exact_leaves):
+    "Return None if the coarse result agrees with the reference."
+    totals = [sum(column) for column in zip(*[leaf[1:] for leaf in result])]
+    if totals != [sum(column) for column in zip(*[
+            leaf[1:] for leaf in expected])]:
+        return 'totals {0!r}'.format(totals)
+    for name, app_size, use_size in result:
+        if name.endswith('*'):
+            continue
+        content = sizes.get(name, (-1, -1))
+        if (app_size, use_size) != content and (
+                exact_leaves or app_size > content[0] or
+                use_size > content[1]):
+            return 'leaf {0} {1!r}'.format(name, (app_size, use_size))
+    return None
+
+
+def check_tree(args):
+    "Scan one generated tree with everything; return a list of failures."
+    shape, seed = args
+    fs_class, maxdepth = SHAPES[shape]
+    fs = fs_class(seed=seed, maxdepth=maxdepth)
+    sizes = content_sizes(fs)
+
+    failures = []
+    for use_apparent_size in (True, False):
+        expected = as_list(reference_scan(fs, '', use_apparent_size))
+        for name, scan, exact_leaves in (
+                [engine + (None,) for engine in ENGINES] + list(
+                    COARSE_ENGINES)):
+            try:
+                result = as_list(scan(fs, use_apparent_size))
+            except Exception as e:
+                result = repr(e)
+            if exact_leaves is None or isinstance(result, str):
+                failure = result != expected and '' or None
+            else:
+                failure = check_coarse(
+                    result, expected, sizes, exact_leaves)
+            if failure is not None:
+                failures.append(
+                    '{0}(seed={1}, maxdepth={2}) {3} {4}: {5}{6!r} != {7!r}'
+                    .format(fs_class.__name__, seed, maxdepth, name,
+                            ('blocks', 'apparent')[use_apparent_size],
+                            failure and failure + ' in ', result, expected))
+    return failures
+
+
+def main():
+    parser = ArgumentParser(
+        description='Check that all dutree engines yield the same trees.')
+    parser.add_argument(
+        '--trees', type=int, default=1000, help='number of trees to check')
+    parser.add_argument(
+        '--jobs', type=int, default=cpu_count(), help='parallel processes')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='first seed to use')
+    args = parser.parse_args()
+
+    work = [
+        (i % len(SHAPES), args.seed + i // len(SHAPES))
+        for i in range(args.trees)]
+    t0 = time.time()
+    failed = 0
+    pool = Pool(args.jobs)
+    try:
+        for failures in pool.imap_unordered(check_tree, work):
+            for failure in failures:
+                print(failure)
+            failed += bool(failures)
+    finally:
+        pool.terminate()
+    print('{0} trees checked in {1:.1f} s, {2} failed'.format(
+        len(work), time.time() - t0, failed))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
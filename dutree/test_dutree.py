@@ -19,10 +19,24 @@
 # and lstat filesystem calls with a bogus on from a GeneratedFilesystem.
 #
 from __future__ import print_function
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from os import path
 from unittest import TestCase, main
+try:
+    from StringIO import StringIO  # python2; takes json.dump() str too
+except ImportError:
+    from io import StringIO
 from bogofs import GeneratedFilesystem, RegularFileNode as BaseRegularFileNode
 
+import bench_dutree
 import dutree
+import fuzz_dutree
 
 
 class DuScanTestMixin(object):
@@ -36,12 +50,8 @@ class DuScanTestMixin(object):
 
     @classmethod
     def duscan_tree(cls, fs, path):
-        # Mock.
-        dutree.listdir = fs.listdir
-        dutree.lstat = fs.stat
-
         # Scan.
-        scanner = dutree.DuScan(path)
+        scanner = dutree.DuScan(path, backend=fs)
         tree = scanner.scan(cls.use_apparent_size)
         return tree
 
@@ -126,6 +136,885 @@ class DuScanSeed1Depth4BlocksTest(DuScanSeed1Depth4Test):
     use_apparent_size = False
 
 
+class DuScanInodeOrderTest(DuScanTestMixin, TestCase):
+    def test_inode_order(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        fs.hide_from_stat('/1.d/13.d/15.txt')
+        expected = self.leaves_as_list(self.duscan_tree(fs, '/'))
+
+        stat_calls = []
+
+        def stat(path):
+            stat_calls.append(path)
+            return fs.stat(path)
+        fs.lstat = stat
+        scanner = dutree.DuScan('/', backend=fs, inode_order=True)
+        tree = scanner.scan()
+
+        self.assertEqual(self.leaves_as_list(tree), expected)
+        self.assertEqual(len(scanner.errors), 1)
+        root_calls = [
+            path for path in stat_calls if path.count('/') == 1]
+        self.assertEqual(
+            root_calls, sorted(
+                root_calls, key=(lambda path: fs.stat(path).st_ino)))
+        self.assertNotEqual(root_calls, sorted(root_calls))
+
+
+class StatxTest(DuScanTestMixin, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = path.realpath(tempfile.mkdtemp(prefix='dutree-test-'))
+        bench_dutree.materialize(
+            GeneratedFilesystem(seed=1, maxdepth=2), cls.tmpdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def scan(self, engine):
+        scanner = dutree.DuScan(
+            self.tmpdir, engine=engine, aggregate=('uid',), ages=True)
+        return self.leaves_as_list(scanner.scan()), scanner
+
+    def test_statx(self):
+        if not dutree.Statx.is_available():
+            self.skipTest('statx() is not available')
+        expected, lstat_scanner = self.scan('lstat')
+        leaves, scanner = self.scan('statx')
+        self.assertEqual(leaves, expected)
+        self.assertEqual(
+            scanner.aggregates['uid'].top(),
+            lstat_scanner.aggregates['uid'].top())
+
+    def test_fallback(self):
+        expected = self.scan('lstat')[0]
+        orig_statx, dutree.Statx._statx = dutree.Statx._statx, False
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                leaves = self.scan('statx')[0]
+        finally:
+            dutree.Statx._statx = orig_statx
+        self.assertEqual(leaves, expected)
+        self.assertEqual(len(caught), 1)
+        self.assertIn('statx() is unavailable', str(caught[0].message))
+
+
+class DuScanInodesTest(DuScanTestMixin, TestCase):
+    def count_below(self, fs, pathname):
+        prefix = pathname.rstrip('/') + '/'
+        return len([
+            name for name in fs._cache_dict
+            if name.startswith(prefix) and name != prefix])
+
+    def test_inodes(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+
+        def stat(path):
+            raise AssertionError('lstat({0!r}) called'.format(path))
+        fs.lstat = stat
+        tree = dutree.DuScan('/', backend=fs, inodes=True).scan()
+
+        self.assertEqual(tree.app_size(), self.count_below(fs, '/'))
+        self.assertEqual(tree.use_size(), tree.app_size())
+        leaves = tree.get_leaves()
+        self.assertEqual(
+            sum(leaf.app_size() for leaf in leaves), tree.app_size())
+        for leaf in leaves:
+            if not leaf.name().endswith('*'):
+                self.assertEqual(
+                    leaf.app_size(), self.count_below(fs, leaf.name()))
+                self.assertGreaterEqual(
+                    leaf.app_size(), tree.app_size() // 20)
+
+    def test_without_scandir(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        expected = self.leaves_as_list(
+            dutree.DuScan('/', backend=fs, inodes=True).scan())
+        backend = dutree.Backend()
+        backend.isdir = fs.isdir
+        backend.listdir = fs.listdir
+        backend.lstat = fs.stat
+        tree = dutree.DuScan('/', backend=backend, inodes=True).scan()
+        self.assertEqual(self.leaves_as_list(tree), expected)
+
+    def test_stat_options(self):
+        self.assertRaises(
+            ValueError, dutree.DuScan, '/', backend=GeneratedFilesystem(),
+            inodes=True, histogram=True)
+
+
+class DuScanStreamingTest(DuScanTestMixin, TestCase):
+    def test_flat_directory(self):
+        # Count the entries that were read but not stat'ed yet.
+        pending = [0, 0]  # now, max
+        fs = fuzz_dutree.FlatFilesystem(seed=2, maxdepth=0)
+        self.assertGreater(len(fs.listdir('/')), 1000)
+
+        def scandir(path):
+            for entry in fs.scandir(path):
+                pending[0] += 1
+                pending[1] = max(pending)
+                yield entry
+
+        def lstat(path):
+            pending[0] -= 1
+            return fs.stat(path)
+
+        backend = dutree.Backend()
+        backend.isdir = fs.isdir
+        backend.scandir = scandir
+        backend.lstat = lstat
+        expected = self.leaves_as_list(self.duscan_tree(fs, '/'))
+        for inode_order, max_pending in ((False, 1), (True, 100)):
+            pending[:] = [0, 0]
+            scanner = dutree.DuScan(
+                '/', backend=backend, inode_order=inode_order)
+            scanner.INODE_WINDOW = 100
+            self.assertEqual(self.leaves_as_list(scanner.scan()), expected)
+            self.assertEqual(pending[1], max_pending)
+
+
+class InventoryBackendTest(DuScanTestMixin, TestCase):
+    def test_inventory(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        lines = []
+        fuzz_dutree.find_printf(fs, '/', lines)
+        for use_apparent_size in (True, False):
+            expected = self.leaves_as_list(
+                dutree.DuScan('/', backend=fs).scan(use_apparent_size))
+            backend = dutree.InventoryBackend(StringIO(u''.join(lines)))
+            tree = dutree.DuScan('/', backend=backend).scan(
+                use_apparent_size)
+            self.assertEqual(self.leaves_as_list(tree), expected)
+
+    def test_not_in_find_order(self):
+        inventory = (
+            u'4096 8 d /srv\n4096 8 d /srv/a\n100 8 f /srv/b.txt\n'
+            u'100 8 f /srv/a/c.txt\n')
+        backend = dutree.InventoryBackend(StringIO(inventory))
+        self.assertRaises(
+            ValueError, dutree.DuScan('/srv', backend=backend).scan)
+        self.assertRaises(
+            OSError, dutree.DuScan, '/srv/a',
+            backend=dutree.InventoryBackend(StringIO(inventory)))
+
+
+class ParallelDuScanTest(DuScanTestMixin, TestCase):
+    def test_device_scheduler(self):
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+
+        def func(dev):
+            with lock:
+                running[dev] = running.get(dev, 0) + 1
+                peak[dev] = max(peak.get(dev, 0), running[dev])
+            time.sleep(0.01)
+            with lock:
+                running[dev] -= 1
+            return dev * 10
+
+        scheduler = dutree.DeviceScheduler(jobs={1: 1, 2: 3, 3: 8})
+        work = [(dev, dev) for dev in (1, 2, 3) for i in range(6)]
+        self.assertEqual(
+            scheduler.run(func, work), [dev * 10 for dev, arg in work])
+        self.assertEqual(peak, {1: 1, 2: 3, 3: 6})
+
+    def test_parallel_scan(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        hidden = fs.stat('/1.d/13.d/15.txt').size
+        total = fs.get_content_size('/') - hidden
+        fs.hide_from_stat('/1.d/13.d/15.txt')
+
+        for split_depth in (1, 2):
+            scanner = dutree.ParallelDuScan(
+                '/', backend=fs, split_depth=split_depth,
+                mount_points=['/', '/0.d/05.d', '/1.d/13.d'])
+            tree = scanner.scan()
+            self.assertEqual(tree.app_size(), total)
+            self.assertEqual(len(scanner.errors), 1)
+            for leaf in tree.get_leaves():
+                if leaf.name().endswith('/'):
+                    self.assertEqual(
+                        leaf.app_size(),
+                        fs.get_content_size(leaf.path()) - (
+                            hidden if '/1.d/13.d/'.startswith(leaf.name())
+                            else 0))
+
+
+class ShardedDuScanTest(DuScanTestMixin, TestCase):
+    def setUp(self):
+        self.tmpdir = path.realpath(tempfile.mkdtemp(prefix='dutree-test-'))
+        self.tree = path.join(self.tmpdir, 'tree')
+        self.queue = path.join(self.tmpdir, 'queue')
+        os.mkdir(self.tree)
+        bench_dutree.materialize(
+            GeneratedFilesystem(seed=1, maxdepth=2), self.tree)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_local_workers(self):
+        kwargs = {'split_depth': 2, 'mount_points': [], 'histogram': True,
+                  'aggregate': ('ext',)}
+        parallel = dutree.ParallelDuScan(self.tree, **kwargs)
+        expected = parallel.scan()
+        sharded = dutree.ShardedDuScan(
+            self.tree, self.queue, local_workers=3, poll_interval=0.05,
+            **kwargs)
+        tree = sharded.scan()
+
+        self.assertEqual(
+            self.leaves_as_list(tree), self.leaves_as_list(expected))
+        self.assertEqual(
+            list(tree.histogram().counts), list(expected.histogram().counts))
+        self.assertEqual(
+            sharded.aggregates['ext'].top(), parallel.aggregates['ext'].top())
+        self.assertEqual(os.listdir(self.queue), [])
+
+    def test_failing_shard(self):
+        kwargs = {'split_depth': 1, 'mount_points': []}
+        expected = dutree.ParallelDuScan(self.tree, **kwargs).scan()
+        sharded = dutree.ShardedDuScan(
+            self.tree, self.queue, local_workers=1, poll_interval=0.05,
+            **kwargs)
+        units = sharded._get_units()
+        missing = path.join(self.tree, 'missing.d')
+        sharded._get_units = (lambda: units + [(0, missing)])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            tree = sharded.scan()
+
+        # The shard was tried three times, then counted as an error.
+        self.assertEqual(
+            self.leaves_as_list(tree), self.leaves_as_list(expected))
+        self.assertEqual(len(sharded.errors), 1)
+        self.assertEqual(sharded.errors.examples[0][0], missing)
+        # The missing dir error has no errno; it gets one to sort on.
+        self.assertEqual(
+            [i[0] for i in sharded.errors.by_errno.top()], [errno.EIO])
+        self.assertEqual(os.listdir(self.queue), [])
+
+    def test_dead_workers(self):
+        def run(worker):
+            os._exit(1)
+        orig_run, dutree.ShardWorker.run = dutree.ShardWorker.run, run
+        try:
+            sharded = dutree.ShardedDuScan(
+                self.tree, self.queue, local_workers=2, poll_interval=0.05,
+                mount_points=[])
+            self.assertRaises(OSError, sharded.scan)
+        finally:
+            dutree.ShardWorker.run = orig_run
+        self.assertEqual(os.listdir(self.queue), [])
+
+    def test_requeue_stale(self):
+        queue = dutree.ShardQueue(self.queue)
+        queue.create({'heartbeat': 1}, ['/a', '/b'])
+        self.assertEqual(queue.claim(), '000000.json')
+        self.assertEqual(queue.claim(), '000001.json')
+        self.assertIsNone(queue.claim())
+        queue.finish('000001.json', {})
+        os.utime(
+            path.join(self.queue, 'claimed', '000000.json'), (0, 0))
+        queue.requeue_stale(600)
+        self.assertFalse(queue.is_done())
+        self.assertEqual(queue.claim(), '000000.json')
+        self.assertEqual(queue.get_shard('000000.json')['path'], '/a')
+        with self.assertRaises(ValueError):
+            dutree.ShardQueue(self.queue).create({}, ['/c'])
+
+
+class WatchdogBackendTest(DuScanTestMixin, TestCase):
+    def setUp(self):
+        self.fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()  # let the abandoned threads finish
+
+    def hanging_backend(self, prefix):
+        "Return a backend that hangs on listdir/lstat below prefix."
+        def hang(func):
+            def call(path):
+                if path.startswith(prefix):
+                    self.release.wait()
+                return func(path)
+            return call
+
+        backend = dutree.Backend()
+        backend.isdir = self.fs.isdir
+        backend.listdir = hang(self.fs.listdir)
+        backend.lstat = hang(self.fs.lstat)
+        return backend
+
+    def test_scan(self):
+        watchdog = dutree.WatchdogBackend(
+            self.hanging_backend('/1.d/'), timeout=0.05,
+            mount_points=['/', '/1.d'])
+        scanner = dutree.DuScan('/', backend=watchdog)
+        tree = scanner.scan()
+
+        # Only the contents of /1.d are missing.
+        self.assertEqual(
+            tree.app_size(),
+            self.fs.get_content_size('/') -
+            self.fs.get_content_size('/1.d'))
+        # The first lstat times out, the others fail right away.
+        names = self.fs.listdir('/1.d')
+        self.assertEqual(watchdog.stalls, {'/1.d': len(names)})
+        self.assertEqual(watchdog.timed_out, ['/1.d/' + names[0]])
+        self.assertEqual(len(scanner.errors), len(names))
+        self.assertEqual(
+            scanner.errors.by_errno.top(),
+            [(errno.ETIMEDOUT, len(names), len(names), 0)])
+
+    def test_stalled_mount_point(self):
+        watchdog = dutree.WatchdogBackend(
+            self.hanging_backend('/1.d/'), timeout=0.05,
+            mount_points=['/', '/1.d'])
+        with self.assertRaises(OSError):
+            watchdog.lstat('/1.d/10.txt')
+        t0 = time.time()
+        with self.assertRaises(OSError) as context:
+            watchdog.lstat('/1.d/11.txt')  # right away
+        self.assertLess(time.time() - t0, 0.05)
+        self.assertEqual(context.exception.errno, errno.ETIMEDOUT)
+        self.assertEqual(watchdog.lstat('/0.d').st_size, 4096)
+        self.assertEqual(watchdog.stalls, {'/1.d': 2})
+
+        self.release.set()
+        time.sleep(0.05)
+        self.assertEqual(watchdog.lstat('/1.d/11.txt').st_mode, 32768)
+
+    def test_inode_order(self):
+        stat_calls = []
+
+        def stat(path):
+            stat_calls.append(path)
+            return self.fs.stat(path)
+        self.fs.lstat = stat
+        watchdog = dutree.WatchdogBackend(self.fs, mount_points=['/'])
+        dutree.DuScan('/', backend=watchdog, inode_order=True).scan()
+
+        # The helper thread did not stat ahead in directory order.
+        self.assertFalse(watchdog.prestat)
+        root_calls = [
+            path for path in stat_calls if path.count('/') == 1]
+        self.assertEqual(
+            root_calls, sorted(
+                root_calls, key=(lambda path: self.fs.stat(path).st_ino)))
+
+
+class ThrottleTest(DuScanTestMixin, TestCase):
+    def test_token_bucket(self):
+        bucket = dutree.TokenBucket(200, burst=1)
+        t0 = time.time()
+        for i in range(21):
+            bucket.take()
+        self.assertGreaterEqual(time.time() - t0, 0.095)
+
+    def test_throttled_scan(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        expected = self.leaves_as_list(self.duscan_tree(fs, '/'))
+        calls = []
+        backend = dutree.Backend()
+        backend.isdir = fs.isdir
+        backend.listdir = (lambda path: calls.append(path) or fs.listdir(path))
+        backend.lstat = (lambda path: calls.append(path) or fs.stat(path))
+        dutree.DuScan('/', backend=backend).scan()
+        calls = len(calls)  # the burst is a tenth of that
+
+        t0 = time.time()
+        tree = dutree.DuScan(
+            '/', backend=fs, max_iops=(calls * 5),
+            max_dirs_per_sec=1000000).scan()
+        elapsed = time.time() - t0
+        self.assertEqual(self.leaves_as_list(tree), expected)
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertLess(elapsed, 1)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class CheckpointTest(DuScanTestMixin, TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='dutree-test-')
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def interrupting_backend(self, fs, after):
+        "Return a backend that raises Interrupted at listdir call after."
+        calls = []
+
+        def listdir(path):
+            calls.append(path)
+            if len(calls) == after:
+                raise Interrupted()
+            return fs.listdir(path)
+
+        backend = dutree.Backend()
+        backend.isdir = fs.isdir
+        backend.listdir = listdir
+        backend.lstat = fs.stat
+        return backend
+
+    def scan(self, backend, resume=None, **kwargs):
+        scanner = dutree.DuScan(
+            '/', backend=backend, checkpoint=self.checkpoint,
+            checkpoint_interval=0, **kwargs)
+        return scanner, scanner.scan(resume=resume)
+
+    def test_resume(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        fs.hide_from_stat('/1.d/13.txt')
+        for kwargs in ({}, {'max_nodes': 12, 'histogram': True,
+                            'aggregate': ('ext',)}, {'inodes': True}):
+            scanner, tree = self.scan(fs, **kwargs)
+            expected = self.leaves_as_list(tree)
+            self.assertFalse(os.path.exists(self.checkpoint))
+
+            for after in (2, 17, 40):
+                with self.assertRaises(Interrupted):
+                    self.scan(self.interrupting_backend(fs, after), **kwargs)
+                state = dutree.DuScan.load_checkpoint(self.checkpoint)
+                resumed, tree = self.scan(fs, resume=state, **kwargs)
+                self.assertEqual(self.leaves_as_list(tree), expected)
+                self.assertEqual(len(resumed.errors), len(scanner.errors))
+                self.assertEqual(
+                    resumed.aggregates.get('ext') and
+                    resumed.aggregates['ext'].top(),
+                    scanner.aggregates.get('ext') and
+                    scanner.aggregates['ext'].top())
+                self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resume_flat_directory(self):
+        fs = fuzz_dutree.FlatFilesystem(seed=2, maxdepth=0)
+        for kwargs in ({}, {'inodes': True}):
+            expected = self.leaves_as_list(self.scan(fs, **kwargs)[1])
+            calls = []
+
+            def lstat(path):
+                calls.append(path)
+                if len(calls) == 1500:
+                    raise Interrupted()
+                return fs.stat(path)
+            backend = self.interrupting_backend(fs, 0)
+            backend.lstat = lstat
+            with self.assertRaises(Interrupted):
+                self.scan(backend, **kwargs)
+            state = dutree.DuScan.load_checkpoint(self.checkpoint)
+            self.assertEqual(
+                [frame[6:8] for frame in state['stack']], [[None, 1000]])
+            tree = self.scan(fs, resume=state, **kwargs)[1]
+            self.assertEqual(self.leaves_as_list(tree), expected)
+
+    def test_resume_watchdog(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        expected = self.leaves_as_list(self.scan(fs)[1])
+        with self.assertRaises(Interrupted):
+            self.scan(self.interrupting_backend(fs, 40))
+        state = dutree.DuScan.load_checkpoint(self.checkpoint)
+        watchdog = dutree.WatchdogBackend(fs, mount_points=['/'])
+        tree = self.scan(watchdog, resume=state)[1]
+        self.assertEqual(self.leaves_as_list(tree), expected)
+        # The stat results of the skipped entries were dropped.
+        self.assertEqual(watchdog._local.stats, {})
+
+    def test_resume_deleted_dir(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        with self.assertRaises(Interrupted):
+            self.scan(self.interrupting_backend(fs, 23))
+        state = dutree.DuScan.load_checkpoint(self.checkpoint)
+        self.assertEqual(  # interrupted in /0.d/01.d/02.d
+            [frame[6:8] for frame in state['stack']],
+            [['0.d', 0], ['01.d', 1], ['02.d', 2], [None, 0]])
+
+        deleted_size = (
+            fs.get_content_size('/0.d/01.d') + fs.stat('/0.d/01.d').size)
+        fs.hide_from_stat('/0.d/01.d')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            tree = self.scan(fs, resume=state)[1]
+        self.assertEqual(len(caught), 1)
+        self.assertIn("'/0.d' changed", str(caught[0].message))
+        self.assertEqual(
+            tree.app_size(), fs.get_content_size('/') - deleted_size)
+
+    def test_resume_other_options(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=2)
+        with self.assertRaises(Interrupted):
+            self.scan(self.interrupting_backend(fs, 3))
+        state = dutree.DuScan.load_checkpoint(self.checkpoint)
+        with self.assertRaises(ValueError) as context:
+            self.scan(fs, resume=state, histogram=True)
+        self.assertIn('options: histogram', str(context.exception))
+
+
+class DuScanExpectedSizeTest(DuScanTestMixin, TestCase):
+    def scan_with_peak(self, fs, **kwargs):
+        "Return the tree and the peak number of nodes in the store."
+        peak = [0]
+        orig_append = dutree._NodeStore.append
+
+        def append(store, *args):
+            peak[0] = max(peak[0], len(store) + 1)
+            return orig_append(store, *args)
+
+        dutree._NodeStore.append = append
+        try:
+            tree = dutree.DuScan('/', backend=fs, **kwargs).scan()
+        finally:
+            dutree._NodeStore.append = orig_append
+        return tree, peak[0]
+
+    def test_expected_size(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        tree, peak = self.scan_with_peak(fs)
+        expected = self.leaves_as_list(tree)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for expected_size in (tree.app_size(), 2 * tree.app_size()):
+                seeded, seeded_peak = self.scan_with_peak(
+                    fs, expected_size=expected_size)
+                self.assertEqual(self.leaves_as_list(seeded), expected)
+                self.assertLess(seeded_peak, peak // 4)
+        self.assertEqual(caught, [])
+
+    def test_expected_size_from_dump(self):
+        tmpdir = path.realpath(tempfile.mkdtemp(prefix='dutree-test-'))
+        cwd = os.getcwd()
+        try:
+            os.mkdir(path.join(tmpdir, 't'))
+            tree = dutree.DuNode.new_dir(path.join(tmpdir, 't'))
+            tree._set_size(1000, 4096)
+            with open(path.join(tmpdir, 'prev.json'), 'w') as fp:
+                dutree.dump(tree, fp)
+            os.chdir(tmpdir)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                for pathname in ('t', 't/', path.join(tmpdir, 't')):
+                    self.assertEqual(dutree.get_expected_size(
+                        'prev.json', pathname, True), 1000)
+                self.assertIsNone(
+                    dutree.get_expected_size('prev.json', '.', True))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(caught), 1)
+        self.assertIn('is a scan of', str(caught[0].message))
+
+    def test_expected_size_too_large(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            tree = self.scan_with_peak(fs, expected_size=(1 << 50))[0]
+        self.assertEqual(len(caught), 1)
+        self.assertIn('may be missing', str(caught[0].message))
+        self.assertEqual(tree.app_size(), 2053393838542)
+
+
+class LiveTreeTest(TestCase):
+    def setUp(self):
+        self.tmpdir = path.realpath(tempfile.mkdtemp(prefix='dutree-test-'))
+        for dir_ in ('a', 'a/aa', 'b'):
+            os.mkdir(path.join(self.tmpdir, dir_))
+        for file_, size in (('a/1', 3000), ('a/aa/2', 70000), ('b/3', 500)):
+            self.write(file_, size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, file_, size, mode='wb'):
+        with open(path.join(self.tmpdir, file_), mode) as fp:
+            fp.write(b'x' * size)
+
+    def check(self, live):
+        "Apply the events; the totals must equal those of a new scan."
+        while not live.update(1):
+            pass
+        while live.update(0.05):
+            pass
+        tree = dutree.DuScan(self.tmpdir).scan()
+        self.assertEqual(
+            (live.tree.app_size(), live.tree.use_size()),
+            (tree.app_size(), tree.use_size()))
+        return [leaf.name() for leaf in live.tree.get_leaves()]
+
+    def test_root(self):
+        class Watcher(object):
+            def __init__(self):
+                self.paths = []
+
+            def add(self, pathname):
+                self.paths.append(pathname)
+
+            def read(self, timeout=None):
+                return set(['/', '/1.d'])
+
+        fs = GeneratedFilesystem(seed=1, maxdepth=2)
+        orig = dutree.listdir, dutree.lstat
+        dutree.listdir, dutree.lstat = fs.listdir, fs.stat
+        try:
+            watcher = Watcher()
+            live = dutree.LiveTree('/', watcher=watcher)
+            tree = live.scan()
+            self.assertEqual(watcher.paths[0], '/')
+            self.assertNotIn('', watcher.paths)
+            expected = (tree.app_size(), tree.use_size())
+            self.assertEqual(live.update(), 2)
+        finally:
+            dutree.listdir, dutree.lstat = orig
+        self.assertEqual(
+            (live.tree.app_size(), live.tree.use_size()), expected)
+
+    def check_watcher(self, watcher):
+        live = dutree.LiveTree(self.tmpdir, watcher=watcher)
+        live.scan()
+        tmpdir = self.tmpdir
+        try:
+            self.write('a/1', 1000, 'ab')
+            self.check(live)
+            os.makedirs(path.join(tmpdir, 'c/cc'))
+            self.write('c/cc/4', 20000)
+            self.write('c/5', 10)
+            self.check(live)
+            self.write('b/big', 1000000)
+            self.assertIn(tmpdir + '/b/big', self.check(live))
+            self.write('c/cc/4', 30000, 'ab')  # in the new dir too
+            self.check(live)
+            os.rename(path.join(tmpdir, 'c'), path.join(tmpdir, 'a/c'))
+            self.check(live)
+            shutil.rmtree(path.join(tmpdir, 'a'))
+            self.check(live)
+            os.unlink(path.join(tmpdir, 'b/big'))
+            self.assertNotIn(tmpdir + '/b/big', self.check(live))
+        finally:
+            watcher.close()
+
+    def test_inotify(self):
+        self.check_watcher(dutree.InotifyWatcher())
+
+    def test_fanotify(self):
+        try:
+            watcher = dutree.FanotifyWatcher(self.tmpdir)
+        except (AttributeError, OSError) as e:
+            self.skipTest('fanotify is unavailable: {0}'.format(e))
+        self.check_watcher(watcher)
+
+
+class DuScanMaxNodesTest(DuScanTestMixin, TestCase):
+    def test_max_nodes(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+
+        peak = []
+        orig_append = dutree._NodeStore.append
+
+        def append(store, *args):
+            peak.append(len(store) + 1)
+            return orig_append(store, *args)
+
+        for max_nodes in (50, 12):
+            dutree._NodeStore.append = append
+            try:
+                tree = dutree.DuScan(
+                    '/', backend=fs, max_nodes=max_nodes).scan()
+            finally:
+                dutree._NodeStore.append = orig_append
+
+            self.assertLessEqual(max(peak), max_nodes + 2)  # +dir +rest
+            self.assertEqual(tree.app_size(), 2053393838542)
+            self.assertEqual(tree.use_size(), 2053435198976)
+            del peak[:]
+
+        # Less precise, but still finds the large top level dirs.
+        self.assertEqual(
+            [name for name, app_size, use_size
+             in self.leaves_as_list(tree)],
+            ['/0.d/', '/1.d/', '/*'])
+
+
+class DuNodeTest(DuScanTestMixin, TestCase):
+    def test_path_from_parents(self):
+        root = dutree.DuNode.new_dir('/srv')
+        data = dutree.DuNode.new_dir('data')
+        root.add_branches(data, dutree.DuNode.new_leftovers(1, 1))
+        data.add_branches(dutree.DuNode.new_file('x.txt', 2, 2))
+        self.assertEqual(data.name(), '/srv/data/')
+        self.assertEqual(data.path(), '/srv/data')
+        self.assertEqual(
+            [leaf.name() for leaf in root.get_leaves()],
+            ['/srv/data/x.txt', '/srv/*'])
+
+    def test_sort_like_paths(self):
+        root = dutree.DuNode.new_dir('')
+        a_dir = dutree.DuNode.new_dir('a')
+        a_dir.add_branches(dutree.DuNode.new_file('b', 1, 1))
+        root.add_branches(
+            dutree.DuNode.new_leftovers(1, 1),
+            dutree.DuNode.new_file(u'\u00ff\u00ff', 1, 1),
+            a_dir,
+            dutree.DuNode.new_file('a.txt', 1, 1),
+            dutree.DuNode('a-b', True, 1, 1),  # a leaf dir
+        )
+        leaves = [leaf.name() for leaf in root.get_leaves()]
+        self.assertEqual(
+            leaves, ['/a-b/', '/a.txt', '/a/b', u'/\u00ff\u00ff', '/*'])
+
+
+class DuScanHistogramTest(DuScanTestMixin, TestCase):
+    def test_histogram(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=3)
+        files = [
+            fs.stat(name.rstrip('/') + '/' + file_).size
+            for name, dirs, files in fs.walk('/') for file_ in files]
+        expected = self.leaves_as_list(
+            dutree.DuScan('/', backend=fs).scan())
+
+        for max_nodes in (None, 20):
+            tree = dutree.DuScan(
+                '/', backend=fs, histogram=True, max_nodes=max_nodes).scan()
+            if max_nodes is None:
+                self.assertEqual(self.leaves_as_list(tree), expected)
+
+            hist = tree.histogram()
+            self.assertEqual(sum(hist.counts), len(files))
+            self.assertEqual(sum(hist.sizes), sum(files))
+            self.assertEqual(
+                sum(hist.sizes), sum(
+                    leaf.histogram() and sum(leaf.histogram().sizes) or 0
+                    for leaf in tree.get_leaves()))
+
+        buckets = list(hist.buckets())
+        self.assertEqual(buckets[0][0:2], (4, 7))
+        self.assertEqual(buckets[-1][0:2], (1 << 30, (1 << 31) - 1))
+
+
+class DuScanAgesTest(DuScanTestMixin, TestCase):
+    def test_ages(self):
+        now = time.time()
+
+        class GeneratedFilesystemWithAges(GeneratedFilesystem):
+            class RegularFileNode(BaseRegularFileNode):
+                @property
+                def st_mtime(self):
+                    return (now - 3600) if self.size % 2 else 0
+
+        fs = GeneratedFilesystemWithAges(seed=1, maxdepth=3)
+        files = [
+            fs.stat(name.rstrip('/') + '/' + file_).size
+            for name, dirs, files in fs.walk('/') for file_ in files]
+        fresh = sum(size for size in files if size % 2)
+        total = dutree.DuScan('/', backend=fs).scan().app_size()
+
+        for max_nodes in (None, 20):
+            tree = dutree.DuScan(
+                '/', backend=fs, ages=True, max_nodes=max_nodes).scan()
+            ages = tree.ages()
+            self.assertEqual(list(ages.sizes), [fresh, 0, 0, 0, total - fresh])
+            self.assertEqual(
+                tree.app_size(), sum(
+                    sum(leaf.ages().sizes) for leaf in tree.get_leaves()))
+
+        tree = dutree.DuScan('/', backend=fs, min_age=86400).scan()
+        self.assertEqual(tree.app_size(), total - fresh)
+
+
+class TreeBrowserTest(DuScanTestMixin, TestCase):
+    def test_browse(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        tree = dutree.DuScan('/', backend=fs, detail=1000).scan(
+            merge_upwards=False)
+        browser = dutree.TreeBrowser(tree)
+
+        def check_view(total):
+            entries = browser.entries()
+            self.assertEqual(browser.total(), total)
+            self.assertEqual(sum(i.app_size() for i in entries), total)
+            for leaf in entries:
+                if leaf.name().endswith('/'):
+                    self.assertEqual(
+                        leaf.app_size(), fs.get_content_size(leaf.path()))
+            return entries
+
+        entries = check_view(tree.app_size())
+        self.assertEqual(
+            [leaf.name() for leaf in entries],
+            ['/0.d/02.d/', '/0.d/05.d/', '/0.d/15.d/', '/0.d/*',
+             '/1.d/00.d/', '/1.d/11.d/', '/1.d/13.d/', '/1.d/*', '/*'])
+
+        # Expand the leftovers of /0.d/.
+        self.assertTrue(browser.enter(3))
+        self.assertEqual(browser.title(), '/0.d/*')
+        rest = check_view(entries[3].app_size())
+        self.assertEqual(rest[-1].name(), '/0.d/*')
+        self.assertFalse(
+            set(leaf.name() for leaf in rest[0:-1]) &
+            set(leaf.name() for leaf in entries))
+
+        # Enter a directory in there.
+        self.assertTrue(browser.enter(0))
+        self.assertEqual(browser.title(), rest[0].name())
+        check_view(rest[0].app_size())
+
+        self.assertTrue(browser.back())
+        self.assertTrue(browser.back())
+        self.assertFalse(browser.back())
+        self.assertEqual(browser.title(), '/')
+
+
+class DuScanAggregateTest(DuScanTestMixin, TestCase):
+    def test_top_counter(self):
+        counter = dutree.TopCounter(size=2)
+        for key, size in (('a', 10), ('b', 20), ('c', 1), ('d', 2),
+                          ('e', 3), ('a', 10), ('f', 5)):
+            counter.add(key, size)
+        self.assertEqual(counter.error(), 3)
+        self.assertEqual(counter.top(3), [
+            ('a', 20, 2, 0), ('b', 20, 1, 0), ('f', 8, 1, 3)])
+
+    def test_aggregate(self):
+        class GeneratedFilesystemWithOwners(GeneratedFilesystem):
+            class RegularFileNode(BaseRegularFileNode):
+                @property
+                def st_uid(self):
+                    return 1000 + (self.size % 2)
+
+        fs = GeneratedFilesystemWithOwners(seed=1, maxdepth=3)
+        files = [
+            fs.stat(name.rstrip('/') + '/' + file_).size
+            for name, dirs, files in fs.walk('/') for file_ in files]
+        scanner = dutree.DuScan(
+            '/', backend=fs, aggregate=('uid', 'gid', 'ext'))
+        tree = scanner.scan()
+        uids = scanner.aggregates['uid'].top()
+        gids = scanner.aggregates['gid'].top()
+        exts = scanner.aggregates['ext'].top()
+
+        self.assertEqual(
+            [uid for uid, size, count, error in uids], [1000, 1001])
+        self.assertEqual(
+            sum(size for uid, size, count, error in uids), tree.app_size())
+        self.assertEqual(
+            [(gid, size) for gid, size, count, error in gids],
+            [(1000, tree.app_size())])
+        self.assertEqual(exts, [('txt', sum(files), len(files), 0)])
+
+
+class DuScanEquivalenceTest(TestCase):
+    def test_engines_match_reference(self):
+        # Only a few trees here; run fuzz_dutree.py for thousands.
+        for shape in range(len(fuzz_dutree.SHAPES)):
+            self.assertEqual(fuzz_dutree.check_tree((shape, 1)), [])
+
+
 class DuScanCopeWithDeletionTest(DuScanTestMixin, TestCase):
     def test_handle_deleted(self):
         fs = GeneratedFilesystem(seed=1, maxdepth=4)
@@ -148,6 +1037,30 @@ class DuScanCopeWithDeletionTest(DuScanTestMixin, TestCase):
         self.assertEqual(dutree_size, fs_size)
         self.assertEqual(dutree_size, 2053393838542 - deleted_size)
 
+    def test_collect_errors(self):
+        fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        fs.hide_from_stat('/0.d/05.d')
+        fs.hide_from_stat('/1.d/13.d/15.txt')
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            scanner = dutree.DuScan('/', backend=fs)
+            scanner.scan()
+        self.assertEqual(caught, [])
+        self.assertEqual(len(scanner.errors), 2)
+        self.assertEqual(scanner.errors.by_errno.top(), [(2, 2, 2, 0)])
+        self.assertEqual(
+            scanner.errors.by_dir.top(),
+            [('/0.d', 1, 1, 0), ('/1.d', 1, 1, 0)])
+        self.assertEqual(
+            [filename for filename, errno, strerror
+             in scanner.errors.examples], ['/0.d/05.d', '/1.d/13.d/15.txt'])
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            dutree.DuScan('/', backend=fs, verbose=True).scan()
+        self.assertEqual(len(caught), 2)
+
 
 class DuScanNoLonelyStarTest(DuScanTestMixin, TestCase):
     @classmethod
@@ -324,5 +1237,205 @@ class DuScanCheckUseSizeTest(DuScanCheckDiffUseSizeMixin, TestCase):
         self.assertEqual(self.leaves_as_list(self.tree), expected)
 
 
+class DuMergeTest(DuScanTestMixin, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dumps = []
+        for seed in (1, 6):
+            fp = StringIO()
+            dutree.dump(cls.duscan_tree(
+                GeneratedFilesystem(seed=seed, maxdepth=4), '/'), fp)
+            cls.dumps.append(fp.getvalue())
+
+    def scan_both(self):
+        return tuple(
+            dutree.load(StringIO(dump))[0] for dump in self.dumps)
+
+    def test_dump_and_load(self):
+        tree = self.scan_both()[0]
+        fp = StringIO()
+        dutree.dump(tree, fp, host='host1')
+        fp.seek(0)
+        loaded, info = dutree.load(fp)
+        self.assertEqual(info['host'], 'host1')
+        self.assertEqual(self.tree_as_list(loaded), self.tree_as_list(tree))
+
+    def test_merge_by_path(self):
+        merger = dutree.DuMerge()
+        for tree in self.scan_both():
+            merger.add(tree)
+        tree = merger.merge()
+
+        self.assertEqual(tree.app_size(), 2053393838542 + 8346127248497)
+        self.assertEqual(self.leaves_as_list(tree), [
+            ('/0.d/', 1030535099482, 1030555604992),
+            ('/00.d/', 962283588169, 962302212608),
+            ('/01.d/', 609253676265, 609265658880),
+            ('/02.d/', 1154398475211, 1154421058560),
+            ('/03.d/', 581440911832, 581452373504),
+            ('/04.d/', 644318151446, 644330290176),
+            ('/05.d/', 762422243930, 762437644288),
+            ('/06.d/', 707913056679, 707927303168),
+            ('/07.d/', 531731374526, 531741905408),
+            ('/08.d/', 891915794716, 891933202944),
+            ('/1.d/', 1020921564726, 1020942406656),
+            ('/*', 1502387150057, 1502416433664),  # /*, /14.d/, ...
+        ])
+
+    def test_merge_by_host(self):
+        merger = dutree.DuMerge(by_host=True)
+        for host, tree in zip(('a', 'b'), self.scan_both()):
+            merger.add(tree, host)
+        tree = merger.merge()
+
+        leaves = self.leaves_as_list(tree)
+        self.assertEqual(leaves[0:3], [
+            ('/a/0.d/', 1030535099482, 1030555604992),
+            ('/a/1.d/', 1020921564726, 1020942406656),
+            ('/a/*', 1937174334, 1937187328),
+        ])
+        self.assertEqual(leaves[-1], ('/b/*', 1500449975723, 1500479246336))
+        self.assertRaises(ValueError, merger.add, self.scan_both()[0])
+
+    def test_relative_path(self):
+        tmpdir = path.realpath(tempfile.mkdtemp(prefix='dutree-test-'))
+        cwd = os.getcwd()
+        stdout = dutree.sys.stdout
+        try:
+            os.makedirs(path.join(tmpdir, 'clitest', 'a'))
+            os.chdir(tmpdir)
+            tree = dutree.DuScan('clitest').scan()
+            self.assertRaises(ValueError, dutree.DuMerge().add, tree)
+
+            # The JSON output has the absolute path, for merging.
+            dutree.sys.stdout = fp = StringIO()
+            dutree.run(dutree.DuScan('clitest/'), True, as_json=True)
+        finally:
+            dutree.sys.stdout = stdout
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+        fp.seek(0)
+        merger = dutree.DuMerge()
+        merger.add_file(fp)
+        self.assertEqual(
+            merger.merge().get_leaves()[0].name(),
+            path.join(tmpdir, 'clitest') + '/')
+
+    def test_collapsed_dir(self):
+        # One host collapsed /srv/a, the other has branches for it.
+        collapsed = dutree.DuNode.new_dir('/srv')
+        collapsed.add_branches(dutree.DuNode.new_dir('a'))
+        collapsed._nodes[0]._set_size(10, 12)
+        expanded = dutree.DuNode.new_dir('/srv')
+        expanded.add_branches(dutree.DuNode.new_dir('a'))
+        expanded._nodes[0].add_branches(
+            dutree.DuNode.new_file('x', 5, 8),
+            dutree.DuNode.new_leftovers(3, 4))
+        for trees in ((collapsed, expanded), (expanded, collapsed)):
+            merger = dutree.DuMerge(small_size=1)
+            for tree in trees:
+                merger.add(dutree.DuNode.from_dict(tree.as_dict()))
+            self.assertEqual(self.leaves_as_list(merger.merge()), [
+                ('/srv/a/x', 5, 8),
+                ('/srv/a/*', 13, 16),
+            ])
+
+    def test_merge_many(self):
+        expected = self.leaves_as_list(self.scan_both()[0])
+        merger = dutree.DuMerge()
+        for i in range(50):
+            merger.add(self.scan_both()[0])
+        tree = merger.merge()
+        self.assertEqual(self.leaves_as_list(tree), [
+            (name, 50 * app_size, 50 * use_size)
+            for name, app_size, use_size in expected])
+
+
+class TreeIndexTest(DuScanTestMixin, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fs = GeneratedFilesystem(seed=1, maxdepth=4)
+        cls.tree = cls.duscan_tree(cls.fs, '/')
+
+    def check_index(self, index):
+        # Exact nodes, with or without trailing slash.
+        self.assertEqual(index.get('/0.d/02.d/').name(), '/0.d/02.d/')
+        self.assertEqual(index.size('/0.d/02.d'), 106577108100)
+        self.assertEqual(index.size('/0.d/02.d', False), 106579299840)
+        self.assertEqual(index.size('/0.d'), 1030535099482)
+        self.assertEqual(index.size('/'), 2053393838542)
+        self.assertEqual(index.find('/1.d/*').name(), '/1.d/*')
+
+        # Folded paths.
+        self.assertIsNone(index.get('/0.d/03.d'))
+        self.assertIsNone(index.size('/0.d/03.d'))
+        self.assertEqual(index.find('/0.d/03.d/1.txt').name(), '/0.d/*')
+        self.assertEqual(
+            index.find('/0.d/02.d/1.d/2.txt').name(), '/0.d/02.d/')
+        self.assertEqual(index.find('/5.txt').name(), '/*')
+
+        self.assertEqual(
+            [leaf.name() for leaf in index.get_leaves('/1.d/')],
+            ['/1.d/00.d/', '/1.d/11.d/', '/1.d/13.d/', '/1.d/*'])
+        self.assertEqual(
+            [leaf.name() for leaf in index.get_leaves('/')],
+            [leaf.name() for leaf in self.tree.get_leaves()])
+        self.assertEqual(
+            [leaf.name() for leaf in index.get_leaves('/1.d/00.d')],
+            ['/1.d/00.d/'])
+
+    def test_scanned(self):
+        self.check_index(dutree.TreeIndex(self.tree))
+
+    def test_loaded(self):
+        fp = StringIO()
+        dutree.dump(self.tree, fp)
+        fp.seek(0)
+        self.check_index(dutree.TreeIndex(dutree.load(fp)[0]))
+
+    def test_outside(self):
+        tree = dutree.DuScan('/0.d', backend=self.fs).scan()
+        index = dutree.TreeIndex(tree)
+        self.assertEqual(index.size('/0.d/'), 1030535099482)
+        self.assertEqual(index.find('/0.d/03.d/1.txt').name(), '/0.d/*')
+        self.assertIsNone(index.find('/1.d/00.d'))
+        self.assertIsNone(index.find('/0.dd'))
+        self.assertEqual(index.get_leaves('/1.d'), [])
+
+    def test_merged_upwards(self):
+        # The leftovers of /a/ went to /*, as merge_upwards does.
+        tree = dutree.DuNode.new_dir('')
+        branch = dutree.DuNode.new_dir('a')
+        branch.add_branches(dutree.DuNode.new_file('b', 10, 10))
+        tree.add_branches(branch, dutree.DuNode.new_leftovers(5, 5))
+        index = dutree.TreeIndex(tree)
+        self.assertEqual(index.find('/a/c').name(), '/*')
+        self.assertEqual(index.find('/a/b').name(), '/a/b')
+        self.assertIsNone(index.find('/a/b/c'))  # a file
+
+
+class MainTest(TestCase):
+    def main(self, *argv):
+        "Run the dutree command; return the usage error."
+        orig = dutree.sys.argv, dutree.sys.stderr
+        dutree.sys.argv = ['dutree'] + list(argv)
+        dutree.sys.stderr = fp = StringIO()
+        try:
+            self.assertRaises(SystemExit, dutree.main)
+        finally:
+            dutree.sys.argv, dutree.sys.stderr = orig
+        return fp.getvalue().rstrip().rsplit('\n', 1)[-1]
+
+    def test_usage_errors(self):
+        self.assertIn(
+            "--by: unknown key 'foo'", self.main('--by', 'uid,foo', '.'))
+        self.assertIn(
+            '--inventory cannot be used with --jobs-per-device',
+            self.main('--inventory', '-', '--jobs-per-device', '2', '/'))
+        self.assertIn(
+            '--timeout cannot be used with --shard-queue',
+            self.main('--timeout', '5', '--shard-queue', 'q', '/'))
+
+
 if __name__ == '__main__':
     main()